@@ -0,0 +1,59 @@
+import datasets
+import numpy as np
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from weak_to_strong.adapters import eval_checkpoints
+from weak_to_strong.checkpoint import load_checkpoint
+from weak_to_strong.eval import eval_loop
+from weak_to_strong.model import TransformerWithHead
+
+
+@pytest.fixture
+def tiny_gpt2(tmp_path):
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=64, n_positions=32, n_embd=16, n_layer=2, n_head=2)
+    path = str(tmp_path / "tiny-gpt2")
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return path
+
+
+def test_eval_checkpoints(tiny_gpt2, tmp_path):
+    rng = np.random.default_rng(0)
+    n = 12
+    labels = rng.integers(0, 2, n)
+    ds = datasets.Dataset.from_dict(
+        {
+            "id": [str(i) for i in range(n)],
+            "txt": [str(i) for i in range(n)],
+            "input_ids": [
+                rng.integers(0, 64, rng.integers(3, 10)).tolist() for _ in range(n)
+            ],
+            "soft_label": [[1.0 - y, float(y)] for y in labels],
+        }
+    )
+    model = TransformerWithHead.from_pretrained(
+        tiny_gpt2, num_labels=2, lora_modules=["c_attn"]
+    )
+    checkpoints = {}
+    for i in range(2):
+        g = torch.Generator().manual_seed(i)
+        for m in model.modules_to_save:
+            for name, p in m.named_parameters():
+                if "base_layer" not in name:
+                    p.data = torch.randn(p.shape, generator=g) * 0.3
+        checkpoints[f"ckpt{i}"] = str(tmp_path / f"ckpt{i}.safetensors")
+        model.save_state_dict(checkpoints[f"ckpt{i}"])
+
+    results, metrics = eval_checkpoints(
+        model, ds, checkpoints, eval_batch_size=4, metric_prefix="eval", verbose=False
+    )
+    assert set(results) == set(checkpoints)
+    for name, path in checkpoints.items():
+        assert f"eval/{name}/acc" in metrics
+        model.load_state_dict(load_checkpoint(path))
+        expected, _ = eval_loop(model, ds, 4, verbose=False)
+        np.testing.assert_allclose(
+            results[name]["logit"], expected["logit"], rtol=1e-4, atol=1e-5
+        )
@@ -0,0 +1,13 @@
+import json
+
+from weak_to_strong.datasets import hf_loader
+
+
+def test_hf_loader_json_streaming(tmp_path):
+    rows = [{"text": f"example {i}", "label": i % 2} for i in range(20)]
+    path = tmp_path / "data.jsonl"
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+
+    loader = hf_loader("json", data_files={"train": str(path)})
+    assert list(loader("train")) == rows
+    assert list(loader("train", streaming=True)) == rows
@@ -9,7 +9,7 @@ import numpy as np
 from datasets import load_from_disk
 
 import weak_to_strong.logger as logger
-from weak_to_strong.common import get_tokenizer, clear_mem, get_gpu_mem_used
+from weak_to_strong.common import get_tokenizer, clear_mem, get_mem_used
 from weak_to_strong.config import (
     MODELS_DICT,
     ModelConfig,
@@ -18,10 +18,22 @@ from weak_to_strong.config import (
 )
 from weak_to_strong.datasets import (
     VALID_DATASETS,
+    dataset_source_hash,
     tokenize_dataset,
     load_and_process_dataset,
+    load_cached_splits,
 )
+from weak_to_strong.device import device_count, set_cpu_autocast, set_num_threads
+from weak_to_strong.distributed import barrier, init_distributed, is_main_process
+from weak_to_strong.model import set_base_model_cache_size
+from weak_to_strong.quantize import check_quantization_device
 from weak_to_strong.train import train_and_save_model
+from weak_to_strong.weak_labels import (
+    is_weak_label_store,
+    join_weak_labels,
+    load_weak_labels,
+    save_weak_labels,
+)
 
 
 def main(
@@ -29,6 +41,9 @@ def main(
     batch_size: int = 32,
     max_ctx: int = 1024,
     ds_name: str = "sciq",
+    # several comma-separated losses (e.g. "kl,xent,logconf") train one head per
+    # loss on the same backbone (w2s linear probes only), with the results of each
+    # head written where a run with that loss alone would write them
     loss: str = "kl",
     # number of documents
     n_train1_docs: int = 20000,
@@ -77,10 +92,81 @@ def main(
     metric_for_best_model: str = "eval/auroc_against_supervision",
     greater_is_better: bool = True,
     save_total_limit: Optional[int] = 1,
+    # batch examples of similar length together to reduce padding
+    bucket_by_length: bool = False,
+    # if set, eval and inference batches are formed by a budget of (padded) tokens
+    # per device rather than by the model's eval_batch_size
+    eval_max_tokens: Optional[int] = None,
+    # number of processes used for tokenization
+    tokenize_num_proc: Optional[int] = None,
+    # processed and tokenized splits are cached on disk and reused by later runs
+    # with the same dataset, seed, split sizes, tokenizer and max_ctx
+    use_dataset_cache: bool = True,
+    # defaults to {results_folder}/dataset_cache
+    dataset_cache_dir: Optional[str] = None,
+    # number of training minibatches prepared ahead of time in a background thread
+    prefetch_depth: int = 0,
+    # stream the source dataset, reading only as many records as needed
+    streaming: bool = False,
+    # if set (with streaming), records are shuffled with a seeded buffer of this size
+    # before taking the first n docs
+    shuffle_buffer_size: Optional[int] = None,
+    # also store the weak model's logits alongside its soft predictions
+    save_weak_logits: bool = False,
+    # with linear_probe, run the transformer once per split and train the head on
+    # the cached last-token hidden states for all epochs
+    cache_features: bool = False,
+    # defaults to {results_folder}/feature_cache
+    feature_cache_dir: Optional[str] = None,
+    # float16 halves the size of the cache, at some loss of precision
+    feature_dtype: str = "float32",
+    # passed to from_pretrained, e.g. "flash_attention_2" to skip padding tokens in
+    # attention with variable-length kernels, or "sdpa"
+    attn_implementation: Optional[str] = None,
+    # if set, several examples are packed into each row of up to this many tokens,
+    # with attention restricted to each example (llama, mistral and qwen2 models)
+    pack_length: Optional[int] = None,
+    # evaluate and make weak labels running the prefix shared by all examples of a
+    # split (e.g. a prompt template) only once
+    cache_prefix: bool = False,
+    # CPU memory budget (in GB) for pristine copies of base models kept in this
+    # process, so that later runs with the same model (e.g. in sweep.py) copy them
+    # instead of loading the weights from disk
+    base_model_cache_gb: float = 0,
+    # with load_best_model_at_end, keep the trainable parameters of the best model in
+    # memory if they take at most this many MB (e.g. LoRA and linear probes), instead
+    # of requiring a checkpoint at every eval that improves the metric
+    best_in_memory_max_mb: float = 0,
+    # number of threads used within and across ops on CPU (torch defaults if None)
+    num_threads: Optional[int] = None,
+    num_interop_threads: Optional[int] = None,
+    # on CPUs with native bf16 support (AVX512-BF16 or AMX), run forward passes of
+    # models loaded in bf16 (i.e. with LoRA) under bf16 autocast. Models fully
+    # fine-tuned in fp32 are unaffected.
+    cpu_autocast: bool = False,
+    # make weak labels with the model's linear layers quantized to int8 (CPU only),
+    # reporting the change in test accuracy and AUROC
+    quantize_inference: bool = False,
+    # run forward passes with the model compiled by torch.compile, padding sequence
+    # lengths to powers of two so that compiled graphs are reused
+    compile_model: bool = False,
+    # log train AUROC, calibration, etc. over windows of this many steps (computed in
+    # the background), rather than over every batch
+    train_metrics_window: int = 1,
 ):
+    set_num_threads(num_threads, num_interop_threads)
+    set_cpu_autocast(cpu_autocast)
+    # when launched with torchrun, train with DDP (gloo on CPU, nccl on GPUs)
+    init_distributed()
+    if quantize_inference:
+        # fail before training rather than after it
+        check_quantization_device()
     # try to clean up memory
     clear_mem()
-    print(f"{get_gpu_mem_used()*100:.2f}% of all GPU memory in use")
+    print(
+        f"{get_mem_used()*100:.2f}% of all {'GPU' if device_count() else 'host'} "
+        "memory in use"
+    )
 
     assert (
         ds_name in VALID_DATASETS
@@ -88,14 +174,24 @@ def main(
     assert (
         weak_model_size is None or weak_labels_path is None
     ), "Can't pass both weak_model_size and weak_labels_path"
+    set_base_model_cache_size(int(base_model_cache_gb * 1024**3))
     model_config = ModelConfig(**MODELS_DICT[model_size])
+    if attn_implementation is not None:
+        model_config.custom_kwargs = dict(
+            model_config.custom_kwargs, attn_implementation=attn_implementation
+        )
     if model_config.model_parallel:
         print(f"Using model parallelism for {model_size}")
 
     is_w2s = weak_labels_path is not None or weak_model_size is not None
     eval_every = w2s_eval_every if is_w2s else gt_eval_every
     epochs = w2s_epochs if is_w2s else gt_epochs
-    loss = loss if is_w2s else "xent"
+    losses = loss.split(",") if isinstance(loss, str) else list(loss)
+    loss = ",".join(losses) if is_w2s else "xent"
+    assert all(
+        name in loss_dict for name in loss.split(",")
+    ), f"Unknown loss {loss}, must be among {list(loss_dict)}"
+    assert "," not in loss or linear_probe, "Several losses require linear_probe"
 
     # this is per device!
     if minibatch_size_per_replica is None:
@@ -147,6 +243,24 @@ def main(
     }
     if is_w2s:
         config["w2s_lr_factor"] = w2s_lr_factor
+    # only added when set, so that existing results folders keep their names
+    if bucket_by_length:
+        config["bucket_by_length"] = bucket_by_length
+    if eval_max_tokens is not None:
+        # changes the batches (and thus the padding) of the examples evaluated
+        config["eval_max_tokens"] = eval_max_tokens
+    if streaming:
+        config["streaming"] = streaming
+        if shuffle_buffer_size is not None:
+            config["shuffle_buffer_size"] = shuffle_buffer_size
+    if linear_probe and cache_features and feature_dtype != "float32":
+        config["feature_dtype"] = feature_dtype
+    if quantize_inference:
+        # changes the weak labels, and thus the results of w2s runs using them
+        config["quantize_inference"] = quantize_inference
+    if cpu_autocast:
+        # changes the numerics (and thus results) of models loaded in bf16
+        config["cpu_autocast"] = cpu_autocast
 
     if weak_model_size is not None:
         weak_model_config = config.copy()
@@ -178,20 +292,60 @@ def main(
     random.seed(seed)
 
     print("DS NAME:", ds_name)
-    # Load dataset
-    dataset = load_and_process_dataset(
-        ds_name,
-        seed=seed,
-        split_sizes=dict(train=n_train1_docs + n_train2_docs, test=n_test_docs),
-    )
+    tokenizer = get_tokenizer(model_config.name)
 
-    # Split the training dataset in half
-    train_dataset, test_ds = dataset["train"], dataset["test"]  # type: ignore
+    def build_splits():
+        # Load dataset
+        dataset = load_and_process_dataset(
+            ds_name,
+            seed=seed,
+            split_sizes=dict(train=n_train1_docs + n_train2_docs, test=n_test_docs),
+            streaming=streaming,
+            shuffle_buffer_size=shuffle_buffer_size,
+        )
+        train_dataset, test_ds = dataset["train"], dataset["test"]  # type: ignore
+        # split off n_train2_docs for getting weak labels
+        split_data = train_dataset.train_test_split(test_size=n_train2_docs, seed=seed)
+
+        # Tokenize datasets
+        return {
+            name: tokenize_dataset(
+                split, tokenizer, max_ctx, num_proc=tokenize_num_proc  # type: ignore
+            )
+            for name, split in [
+                ("train1", split_data["train"]),
+                ("train2", split_data["test"]),
+                ("test", test_ds),
+            ]
+        }
+
+    if use_dataset_cache and dataset_cache_dir is None:
+        dataset_cache_dir = os.path.join(results_folder, "dataset_cache")
+    # the main process builds the dataset cache, which the other processes then load
+    if not is_main_process():
+        barrier()
+    splits = load_cached_splits(
+        dataset_cache_dir if use_dataset_cache else None,
+        key=dict(
+            ds_name=ds_name,
+            seed=seed,
+            split_sizes=dict(
+                train1=n_train1_docs, train2=n_train2_docs, test=n_test_docs
+            ),
+            tokenizer=model_config.name,
+            max_ctx=max_ctx,
+            streaming=streaming,
+            shuffle_buffer_size=shuffle_buffer_size,
+            source=dataset_source_hash(ds_name),
+        ),
+        build_fn=build_splits,
+    )
+    if is_main_process():
+        barrier()
+    test_ds = splits["test"]
 
     if weak_labels_path is None:  # train on ground truth
-        # split off half for getting weak labels
-        split_data = train_dataset.train_test_split(test_size=n_train2_docs, seed=seed)
-        train1_ds, train2_ds = split_data["train"], split_data["test"]
+        train1_ds, train2_ds = splits["train1"], splits["train2"]
         if skip_inference:
             train2_ds = None
             print("len(train1):", len(train1_ds), "(skipping inference)")
@@ -201,7 +355,7 @@ def main(
     else:
         if not weak_labels_path.endswith("weak_labels"):
             weak_labels_path = weak_labels_path + "/weak_labels"
-        if sync_command is not None:
+        if sync_command is not None and is_main_process():
             sync_command_list = sync_command.split(" ")
             sync_command_list.extend(
                 [
@@ -216,16 +370,31 @@ def main(
                 raise RuntimeError(
                     f"Sync command failed with return code {result.returncode}"
                 )
+        barrier()
 
         # take the predictions from the weak model to be the labels
-        train1_ds = load_from_disk(weak_labels_path).rename_columns(
-            {
-                "hard_label": "gt_hard_label",
-                "soft_label": "gt_soft_label",
-                "hard_pred": "hard_label",
-                "soft_pred": "soft_label",
-            }
-        )
+        if is_weak_label_store(weak_labels_path):
+            # the weak model made these predictions on its train2 split, which is
+            # the same as ours, so we join them to our tokenization of it
+            train1_ds = join_weak_labels(
+                splits["train2"], load_weak_labels(weak_labels_path)
+            )
+        else:
+            # weak labels saved as full inference results by older versions
+            train1_ds = load_from_disk(weak_labels_path).rename_columns(
+                {
+                    "hard_label": "gt_hard_label",
+                    "soft_label": "gt_soft_label",
+                    "hard_pred": "hard_label",
+                    "soft_pred": "soft_label",
+                }
+            )
+            train1_ds = tokenize_dataset(
+                train1_ds,
+                tokenizer,
+                max_ctx,
+                num_proc=tokenize_num_proc,  # type: ignore
+            )
         train2_ds = None
 
         weak_model_config = json.load(
@@ -236,9 +405,21 @@ def main(
         config["weak_model"] = weak_model_config
 
     save_path = os.path.join(results_folder, sweep_subfolder, config_name)
+    # with several losses, the results of each head go where a run with its loss
+    # alone would put them, so that they are picked up like those of separate runs
+    head_paths = {}
+    for name in loss.split(",") if "," in loss else []:
+        head_config = {k: v for k, v in config.items() if k != "weak_model"}
+        head_config["loss"] = name
+        head_paths[name] = os.path.join(
+            results_folder, sweep_subfolder, get_config_foldername(head_config)
+        )
 
     if (
-        os.path.exists(os.path.join(save_path, "results_summary.json"))
+        all(
+            os.path.exists(os.path.join(path, "results_summary.json"))
+            for path in list(head_paths.values()) or [save_path]
+        )
         and skip_if_exists
     ):
         print(f"Skipping {save_path} because it already exists")
@@ -256,13 +437,6 @@ def main(
         ),
     )
 
-    # Tokenize datasets
-    tokenizer = get_tokenizer(model_config.name)
-    train1_ds = tokenize_dataset(train1_ds, tokenizer, max_ctx)  # type: ignore
-    test_ds = tokenize_dataset(test_ds, tokenizer, max_ctx)  # type: ignore
-    if train2_ds:
-        train2_ds = tokenize_dataset(train2_ds, tokenizer, max_ctx)
-
     # try to add a weak_labels column to the test dataset if running w2s
     if weak_labels_path is not None:
         weak_test_results_path = weak_labels_path.replace(
@@ -270,18 +444,28 @@ def main(
         )
         if os.path.exists(weak_test_results_path):
             weak_test_results = load_from_disk(weak_test_results_path)
-            # the last minibatch is dropped, so we don't have weak test results for it
-            test_ds = test_ds.select(range(len(weak_test_results))).add_column(
-                "weak_soft_label", weak_test_results["soft_pred"]
+            # the weak model may not have been evaluated on every test example
+            # (e.g. the last partial batch is dropped), so we join on ids
+            weak_soft_preds = dict(
+                zip(weak_test_results["id"], weak_test_results["soft_pred"])
+            )
+            test_ds = test_ds.filter(lambda ex: ex["id"] in weak_soft_preds)
+            test_ds = test_ds.add_column(
+                "weak_soft_label", [weak_soft_preds[id] for id in test_ds["id"]]
             )  # type: ignore
-            assert test_ds["id"] == weak_test_results["id"], "IDs don't match"
         else:
             print(
                 f"No weak test results at {weak_test_results_path}, "
                 "some metrics will not be logged."
             )
 
-    loss_fn = loss_dict[loss]
+    if cache_features and feature_cache_dir is None:
+        feature_cache_dir = os.path.join(results_folder, "feature_cache")
+
+    if "," in loss:  # one head per loss
+        loss_fn = {name: loss_dict[name] for name in loss.split(",")}
+    else:
+        loss_fn = loss_dict[loss]
     print(f"Training model {model_size}")
     test_results, weak_ds = train_and_save_model(
         model_config,
@@ -306,32 +490,66 @@ def main(
         metric_for_best_model=metric_for_best_model,
         greater_is_better=greater_is_better,
         save_total_limit=save_total_limit,
+        bucket_by_length=bucket_by_length,
+        seed=seed,
+        eval_max_tokens=eval_max_tokens,
+        prefetch_depth=prefetch_depth,
+        cache_features=cache_features,
+        feature_cache_dir=feature_cache_dir,
+        feature_dtype=feature_dtype,
+        pack_length=pack_length,
+        cache_prefix=cache_prefix,
+        best_in_memory_max_bytes=int(best_in_memory_max_mb * 1024**2),
+        quantize_inference=quantize_inference,
+        compile_model=compile_model,
+        train_metrics_window=train_metrics_window,
     )
 
-    if weak_ds is not None:
-        weak_ds.save_to_disk(save_path + "/" + "weak_labels")
-
-    acc = np.mean([x["acc"] for x in test_results])  # type: ignore
-    res_dict = {"accuracy": acc}
-    print("accuracy:", acc)
+    # results are written by the main process only
+    if not is_main_process():
+        return
 
-    with open(os.path.join(save_path, "config.json"), "w") as f:
-        json.dump(config, f, indent=2)
+    if weak_ds is not None:
+        save_weak_labels(
+            weak_ds, save_path + "/" + "weak_labels", save_logits=save_weak_logits
+        )
 
-    with open(os.path.join(save_path, "results_summary.json"), "w") as f:
-        json.dump(res_dict, f, indent=2)
+    def save_summary(path, config, test_results):
+        acc = np.mean([x["acc"] for x in test_results])  # type: ignore
+        res_dict = {"accuracy": acc}
+        print("accuracy:", acc)
+
+        with open(os.path.join(path, "config.json"), "w") as f:
+            json.dump(config, f, indent=2)
+
+        with open(os.path.join(path, "results_summary.json"), "w") as f:
+            json.dump(res_dict, f, indent=2)
+
+    if head_paths:
+        with open(os.path.join(save_path, "config.json"), "w") as f:
+            json.dump(config, f, indent=2)
+        for name, head_path in head_paths.items():
+            print(f"Head {name}:")
+            os.makedirs(head_path, exist_ok=True)
+            test_results[name].save_to_disk(  # type: ignore
+                os.path.join(head_path, "eval_results_final")
+            )
+            save_summary(head_path, dict(config, loss=name), test_results[name])
+    else:
+        save_summary(save_path, config, test_results)
 
     if sync_command is not None:
         print("Syncing results to remote storage...")
         try:
-            sync_command_list = sync_command.split(" ")
-            sync_command_list.extend(["upload", save_path, results_folder])
-            print(f"Running sync command: {' '.join(sync_command_list)}")
-            result = subprocess.run(sync_command_list, check=True)
-            if result.returncode != 0:
-                raise RuntimeError(
-                    f"Sync command failed with return code {result.returncode}"
-                )
+            for path in [save_path, *head_paths.values()]:
+                sync_command_list = sync_command.split(" ")
+                sync_command_list.extend(["upload", path, results_folder])
+                print(f"Running sync command: {' '.join(sync_command_list)}")
+                result = subprocess.run(sync_command_list, check=True)
+                if result.returncode != 0:
+                    raise RuntimeError(
+                        f"Sync command failed with return code {result.returncode}"
+                    )
         except Exception as e:
             raise RuntimeError("Failed to sync results to remote storage.") from e
 
@@ -0,0 +1,158 @@
+from typing import Optional, Union
+
+import datasets
+import torch
+from peft.tuners.lora.layer import LoraLayer
+
+from weak_to_strong.checkpoint import load_checkpoint
+from weak_to_strong.eval import eval_loop
+from weak_to_strong.model import TransformerWithHead
+
+
+class MultiAdapterModel(torch.nn.Module):
+    """
+    Evaluates several LoRA checkpoints of the same TransformerWithHead (as saved by
+    train_model) in a single batched pass over the shared base model.
+
+    Each batch is repeated once per checkpoint. The LoRA adapters of the model are
+    disabled, and forward hooks add the low-rank update of each checkpoint to the
+    rows of its copy of the batch, and apply its head. The base weights are thus
+    loaded (and read from memory) once for all checkpoints.
+
+    Use as a context manager: hooks are registered on enter and removed on exit.
+    Logits are of shape [batch_size, num_checkpoints, num_labels], like those of
+    a model with several heads, so that eval_loop returns results per checkpoint.
+    """
+
+    def __init__(self, model: TransformerWithHead, state_dicts: list[list[dict]]):
+        super().__init__()
+        assert (
+            model.lora_modules is not None
+        ), "only LoRA checkpoints can be evaluated together"
+        assert model.num_heads == 1, "checkpoints must have a single head"
+        self.model = model
+        self.num_adapters = len(state_dicts)
+        modules = model.modules_to_save
+        for states in state_dicts:
+            assert len(states) == len(modules), "checkpoint does not match the model"
+            # LoRA checkpoints also hold the (frozen) base weights of their layers
+            for m, sd in zip(modules, states):
+                for name, t in sd.items():
+                    if name.startswith("base_layer."):
+                        assert torch.equal(
+                            t.to(m.state_dict()[name]), m.state_dict()[name]
+                        ), "checkpoints must share the base model"
+
+        # stacked [num_adapters, ...] weights of each module
+        self.stacked: dict[torch.nn.Module, dict[str, torch.Tensor]] = {}
+        for i, m in enumerate(modules):
+            if isinstance(m, LoraLayer):
+                adapter = next(iter(m.lora_A))
+                names = [f"lora_A.{adapter}.weight", f"lora_B.{adapter}.weight"]
+                dtype = m.lora_A[adapter].weight.dtype
+            else:  # the head
+                names = ["weight"]
+                dtype = m.weight.dtype
+            device = next(m.parameters()).device
+            self.stacked[m] = {
+                name: torch.stack([states[i][name] for states in state_dicts]).to(
+                    device, dtype
+                )
+                for name in names
+            }
+        self._hooks: list = []
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def _lora_hook(self, module, args, output):
+        adapter = next(iter(module.lora_A))
+        stacked = self.stacked[module]
+        lora_A = stacked[f"lora_A.{adapter}.weight"]  # [n, r, in]
+        lora_B = stacked[f"lora_B.{adapter}.weight"]  # [n, out, r]
+        x = args[0].to(lora_A.dtype)
+        x = x.reshape(self.num_adapters, -1, x.shape[-1])
+        delta = torch.bmm(torch.bmm(x, lora_A.transpose(1, 2)), lora_B.transpose(1, 2))
+        delta = delta.reshape(output.shape) * module.scaling[adapter]
+        return (output + delta).to(output.dtype)
+
+    def _score_hook(self, module, args, output):
+        weight = self.stacked[module]["weight"]  # [n, num_labels, hidden]
+        hidden_states = args[0].reshape(self.num_adapters, -1, args[0].shape[-1])
+        logits = torch.bmm(hidden_states.to(weight.dtype), weight.transpose(1, 2))
+        return logits.reshape(-1, weight.shape[1])
+
+    def __enter__(self):
+        for m in self.stacked:
+            hook = self._lora_hook if isinstance(m, LoraLayer) else self._score_hook
+            self._hooks.append(m.register_forward_hook(hook))
+        for m in self.model.lm.modules():
+            if isinstance(m, LoraLayer):
+                m.enable_adapters(False)
+        return self
+
+    def __exit__(self, *exc):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        for m in self.model.lm.modules():
+            if isinstance(m, LoraLayer):
+                m.enable_adapters(True)
+
+    def forward(self, input_ids, choice_input_ids=None, attention_mask=None, **kwargs):
+        assert not kwargs, f"unsupported inputs {list(kwargs)}"
+        assert self._hooks, "MultiAdapterModel must be used as a context manager"
+
+        def repeat(t):
+            if t is None:
+                return None
+            return t.repeat(self.num_adapters, *[1] * (t.dim() - 1))
+
+        logits = self.model(
+            repeat(input_ids),
+            choice_input_ids=repeat(choice_input_ids),
+            attention_mask=repeat(attention_mask),
+        )
+        # [num_adapters * batch_size, num_labels] -> [batch_size, num_adapters, ...]
+        return logits.view(self.num_adapters, -1, logits.shape[-1]).transpose(0, 1)
+
+
+def eval_checkpoints(
+    model: TransformerWithHead,
+    ds: datasets.Dataset,
+    checkpoints: Union[dict[str, str], list[str]],
+    eval_batch_size: int = 16,
+    metric_prefix: Optional[str] = None,
+    **eval_kwargs,
+) -> tuple[dict[str, datasets.Dataset], dict[str, float]]:
+    """
+    Evaluates several LoRA checkpoints of a model (e.g. the intermediate checkpoints
+    of a run, or the weak models of several seeds) on ds in a single batched pass.
+
+    Since each batch is repeated once per checkpoint, eval_batch_size (or max_tokens)
+    should be divided by the number of checkpoints to keep memory use unchanged.
+
+    Parameters:
+    model: A TransformerWithHead with the LoRA configuration of the checkpoints.
+        Its own LoRA and head weights are not used.
+    checkpoints: The paths of the checkpoints, optionally keyed by names.
+    eval_kwargs: Other arguments of eval_loop (packing, prefix caching and
+        features are not supported).
+
+    Returns:
+    A dict from checkpoint name (or path) to eval results, and the metrics of all
+    checkpoints, prefixed with {metric_prefix}/{checkpoint name}.
+    """
+    if not isinstance(checkpoints, dict):
+        checkpoints = {path: path for path in checkpoints}
+    state_dicts = [load_checkpoint(path) for path in checkpoints.values()]
+    with MultiAdapterModel(model, state_dicts) as multi_model:
+        return eval_loop(
+            multi_model,
+            ds,
+            eval_batch_size,
+            metric_prefix=metric_prefix,
+            head_names=list(checkpoints),
+            **eval_kwargs,
+        )
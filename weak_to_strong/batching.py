@@ -0,0 +1,398 @@
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, Optional, Sequence
+
+import datasets
+import numpy as np
+import pyarrow as pa
+import torch
+
+
+def sequential_batches(
+    n: int, batch_size: int, drop_last: bool = False
+) -> list[np.ndarray]:
+    """Splits the indices 0..n-1 into batches, in stored order"""
+    end = n - n % batch_size if drop_last else n
+    return [np.arange(i, min(i + batch_size, end)) for i in range(0, end, batch_size)]
+
+
+def bucketed_batches(
+    lengths: np.ndarray,
+    batch_size: int,
+    shuffle: bool = False,
+    seed: int = 0,
+    megabatch_factor: Optional[int] = 50,
+    drop_last: bool = False,
+) -> list[np.ndarray]:
+    """
+    Groups examples of similar length into the same batch to minimize padding.
+
+    Examples are split into megabatches of `megabatch_factor * batch_size` examples,
+    each of which is sorted by length and cut into batches. If `megabatch_factor` is
+    None, the whole dataset is sorted at once.
+
+    Parameters:
+    lengths: The number of tokens of each example.
+    batch_size: The number of examples per batch.
+    shuffle: Whether to shuffle examples before forming megabatches and to shuffle
+        the order of the resulting batches. The last (possibly partial) batch is
+        always kept last.
+    seed: The seed used for shuffling.
+    megabatch_factor: The number of batches per megabatch.
+    drop_last: Whether to drop the last batch if it is partial.
+
+    Returns:
+    A list of arrays of indices, one per batch.
+    """
+    rng = np.random.default_rng(seed)
+    indices = rng.permutation(len(lengths)) if shuffle else np.arange(len(lengths))
+    megabatch_size = (
+        len(indices) if megabatch_factor is None else megabatch_factor * batch_size
+    )
+    megabatch_size = max(megabatch_size, 1)
+    sorted_indices = np.concatenate(
+        [
+            mb[np.argsort(lengths[mb], kind="stable")]
+            for mb in np.array_split(
+                indices, range(megabatch_size, len(indices), megabatch_size)
+            )
+        ]
+    )
+    batches = sequential_batches(len(sorted_indices), batch_size, drop_last)
+    batches = [sorted_indices[b] for b in batches]
+    if shuffle and batches:
+        partial = batches.pop() if len(batches[-1]) < batch_size else None
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+        if partial is not None:
+            batches.append(partial)
+    return batches
+
+
+def token_budget_batches(lengths: np.ndarray, max_tokens: int) -> list[np.ndarray]:
+    """
+    Forms batches such that the number of rows times the padded length of each
+    batch does not exceed `max_tokens`, so that many short examples or few long
+    ones are put in each batch. Examples are taken longest first, so that running
+    out of memory happens early, and no example is dropped.
+
+    Parameters:
+    lengths: The number of tokens of each example.
+    max_tokens: The maximum number of (padded) tokens per batch. Examples longer
+        than this are put in a batch of their own.
+
+    Returns:
+    A list of arrays of indices, one per batch.
+    """
+    sorted_indices = np.argsort(-lengths, kind="stable")
+    batches = []
+    start = 0
+    while start < len(sorted_indices):
+        # the first example of each batch is its longest
+        n_rows = max(max_tokens // max(int(lengths[sorted_indices[start]]), 1), 1)
+        batches.append(sorted_indices[start : start + n_rows])
+        start += n_rows
+    return batches
+
+
+def padding_efficiency(lengths: np.ndarray, batches: Iterable[Sequence[int]]) -> float:
+    """Returns the ratio of real tokens to padded tokens when padding each batch
+    to its longest example"""
+    real, padded = 0, 0
+    for b in batches:
+        if len(b) == 0:
+            continue
+        b_lengths = lengths[np.asarray(b)]
+        real += int(b_lengths.sum())
+        padded += int(b_lengths.max()) * len(b_lengths)
+    return real / padded if padded else 1.0
+
+
+def bucket_length(length: int, max_length: Optional[int] = None) -> int:
+    """
+    Rounds a padded length up to the next power of two (but not beyond max_length),
+    so that batches come in few distinct shapes, e.g. for compiled models.
+    """
+    bucket = 1 << max(int(length) - 1, 0).bit_length()
+    if max_length is not None:
+        bucket = min(bucket, max(max_length, length))
+    return bucket
+
+
+def pack_rows(lengths: np.ndarray, max_length: int) -> list[np.ndarray]:
+    """
+    Packs examples into rows of at most `max_length` tokens, with the first-fit
+    decreasing heuristic. Examples longer than `max_length` get a row of their own.
+
+    Returns:
+    A list of arrays of indices into `lengths`, one per row.
+    """
+    rows: list[list[int]] = []
+    free: list[int] = []
+    for i in np.argsort(-lengths, kind="stable"):
+        length = int(lengths[i])
+        for r in range(len(rows)):
+            if free[r] >= length:
+                rows[r].append(i)
+                free[r] -= length
+                break
+        else:
+            rows.append([i])
+            free.append(max_length - length)
+    return [np.array(row, dtype=np.int64) for row in rows]
+
+
+def _list_column_to_numpy(
+    table: pa.Table, name: str, dtype
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the flattened values and the offsets of a list column"""
+    col = table[name].combine_chunks()
+    offsets = np.asarray(col.offsets, dtype=np.int64)
+    values = col.flatten().to_numpy(zero_copy_only=False).astype(dtype, copy=False)
+    return values, offsets - offsets[0]
+
+
+@dataclass
+class TokenizedArrays:
+    """
+    Compact, pre-collated storage of a tokenized dataset, so that minibatches can be
+    formed without materializing Python lists: the input_ids of all examples are
+    concatenated in a single int32 buffer, and labels are stored as float32 arrays.
+    """
+
+    # all input_ids, concatenated
+    tokens: np.ndarray
+    # example i is tokens[offsets[i] : offsets[i + 1]]
+    offsets: np.ndarray
+    # [n, 2] arrays
+    soft_labels: np.ndarray
+    gt_soft_labels: Optional[np.ndarray] = None
+    weak_soft_labels: Optional[np.ndarray] = None
+    choice_input_ids: Optional[np.ndarray] = None
+    # [n, hidden_size] inputs of the linear head, see features.add_features
+    features: Optional[np.ndarray] = None
+
+    # dataset column -> (attribute, dtype)
+    COLUMNS = {
+        "soft_label": ("soft_labels", np.float32),
+        "gt_soft_label": ("gt_soft_labels", np.float32),
+        "weak_soft_label": ("weak_soft_labels", np.float32),
+        "choice_input_ids": ("choice_input_ids", np.int64),
+    }
+
+    @classmethod
+    def from_dataset(cls, ds: datasets.Dataset) -> "TokenizedArrays":
+        columns = ["input_ids"] + [c for c in cls.COLUMNS if c in ds.column_names]
+        table = ds.select_columns(columns).with_format("arrow")[:]
+        tokens, offsets = _list_column_to_numpy(table, "input_ids", np.int32)
+        arrays = {}
+        for column, (attr, dtype) in cls.COLUMNS.items():
+            if column in columns:
+                values, _ = _list_column_to_numpy(table, column, dtype)
+                arrays[attr] = values.reshape(len(ds), -1)
+        return cls(tokens=tokens, offsets=offsets, **arrays)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def common_prefix_length(self) -> int:
+        """
+        Returns the length of the longest prefix of tokens shared by all examples,
+        leaving at least one token of each example out of it.
+        """
+        if len(self) == 0:
+            return 0
+        starts = self.offsets[:-1]
+        max_length = int(self.lengths.min()) - 1
+        length = 0
+        while length < max_length:
+            column = self.tokens[starts + length]
+            if not (column == column[0]).all():
+                break
+            length += 1
+        return length
+
+    def num_tokens(self, indices: Sequence[int]) -> int:
+        """Returns the number of real (non-padding) tokens of the given examples"""
+        indices = np.asarray(indices, dtype=np.int64)
+        return int((self.offsets[indices + 1] - self.offsets[indices]).sum())
+
+    def collate(
+        self, indices: Sequence[int], skip: int = 0, pad_to_bucket: bool = False
+    ) -> dict[str, torch.Tensor]:
+        """
+        Returns the examples at the given indices as tensors, with input_ids
+        right-padded with zeros to the longest example and an attention_mask that
+        is 1 on real tokens. If features are set, they are returned instead.
+
+        The first `skip` tokens of each example are left out (see
+        common_prefix_length). If pad_to_bucket, input_ids are padded further, to
+        the bucket_length of the longest example (at most the longest example of
+        all).
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.features is not None:
+            batch = {"features": torch.from_numpy(np.asarray(self.features[indices]))}
+        else:
+            length = None
+            if pad_to_bucket and len(indices) > 0:
+                length = bucket_length(
+                    int(self.lengths[indices].max()) - skip,
+                    int(self.lengths.max()) - skip,
+                )
+            batch = self._collate_tokens(indices, skip, length)
+        for column, (attr, _) in self.COLUMNS.items():
+            values = getattr(self, attr)
+            if values is not None:
+                batch[column] = torch.from_numpy(values[indices])
+        return batch
+
+    def collate_packed(
+        self, indices: Sequence[int], max_length: int
+    ) -> dict[str, torch.Tensor]:
+        """
+        Like collate, but concatenates several examples into each row of input_ids
+        (see pack_rows), so that short examples waste little compute on padding.
+
+        Returns tensors with:
+        input_ids, position_ids: [rows, length], with positions restarting at 0 at
+            the beginning of each example.
+        attention_mask: [rows, 1, length, length] boolean block-diagonal causal
+            mask, so that examples only attend to their own tokens.
+        example_ends: [n] the index of the last token of each example in the
+            flattened input_ids.
+        Other columns are per example, in the order of `indices`.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        rows = pack_rows(lengths, max_length)
+        # row and start position within the row of each example
+        row_of = np.empty(len(indices), dtype=np.int64)
+        start_in_row = np.empty(len(indices), dtype=np.int64)
+        for r, row in enumerate(rows):
+            row_of[row] = r
+            start_in_row[row] = np.cumsum(lengths[row]) - lengths[row]
+        row_length = int((start_in_row + lengths).max(initial=0))
+
+        example_of_token = np.repeat(np.arange(len(indices)), lengths)
+        position = np.arange(len(example_of_token)) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        dst = (row_of[example_of_token], start_in_row[example_of_token] + position)
+        input_ids = np.zeros((len(rows), row_length), dtype=np.int64)
+        input_ids[dst] = self.tokens[starts[example_of_token] + position]
+        position_ids = np.zeros_like(input_ids)
+        position_ids[dst] = position
+        # padding tokens are segment 0 and only attend to padding
+        segments = np.zeros_like(input_ids)
+        segments[dst] = example_of_token + 1
+        mask = (segments[:, :, None] == segments[:, None, :]) & np.tri(
+            row_length, dtype=bool
+        )
+
+        batch = {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy(mask[:, None]),
+            "position_ids": torch.from_numpy(position_ids),
+            "example_ends": torch.from_numpy(
+                row_of * row_length + start_in_row + lengths - 1
+            ),
+        }
+        for column, (attr, _) in self.COLUMNS.items():
+            values = getattr(self, attr)
+            if values is not None:
+                batch[column] = torch.from_numpy(values[indices])
+        return batch
+
+    def _collate_tokens(
+        self, indices: np.ndarray, skip: int = 0, length: Optional[int] = None
+    ) -> dict[str, torch.Tensor]:
+        starts = self.offsets[indices] + skip
+        lengths = self.offsets[indices + 1] - starts
+        positions = np.arange(max(lengths.max(initial=0), length or 0))
+        mask = positions[None, :] < lengths[:, None]
+        input_ids = np.zeros(mask.shape, dtype=np.int64)
+        input_ids[mask] = self.tokens[(starts[:, None] + positions[None, :])[mask]]
+        return {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy(mask.astype(np.int64)),
+        }
+
+
+class Prefetcher:
+    """
+    Collates batches in a background thread, keeping up to `depth` of them ready,
+    so that the device does not idle while the next batch is prepared. Batches are
+    yielded in the same order as `index_batches`.
+
+    If `device` is given, tensors are moved to it with non-blocking transfers, from
+    pinned host memory when the device is a GPU.
+    """
+
+    _DONE = object()
+
+    def __init__(
+        self,
+        collate_fn: Callable[[np.ndarray], dict[str, torch.Tensor]],
+        index_batches: Iterable[np.ndarray],
+        depth: int = 2,
+        device=None,
+    ):
+        assert depth > 0, "prefetch depth must be positive"
+        self.collate_fn = collate_fn
+        self.index_batches = index_batches
+        self.device = device
+        self.pin_memory = (
+            device is not None
+            and torch.cuda.is_available()
+            and torch.device(device).type == "cuda"
+        )
+        self._queue: queue.Queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _prepare(self, idx: np.ndarray) -> dict[str, torch.Tensor]:
+        batch = self.collate_fn(idx)
+        if self.pin_memory:
+            batch = {k: v.pin_memory() for k, v in batch.items()}
+        if self.device is not None:
+            batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+        return batch
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker(self):
+        try:
+            for idx in self.index_batches:
+                if not self._put(self._prepare(idx)):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._DONE)
+
+    def __iter__(self) -> Iterator[dict[str, torch.Tensor]]:
+        while True:
+            item = self._queue.get()
+            if item is self._DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
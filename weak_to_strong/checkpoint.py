@@ -0,0 +1,145 @@
+import json
+import os
+import queue
+import threading
+from typing import Optional, Union
+
+import torch
+from safetensors.torch import load_file, save_file
+
+# state dicts of full models, or lists of the state dicts of the LoRA layers and head
+State = Union[dict[str, torch.Tensor], list[dict[str, torch.Tensor]]]
+
+CHECKPOINT_FORMAT = "weak_to_strong_v1"
+
+
+def _flatten(state: State) -> tuple[dict[str, torch.Tensor], dict[str, str]]:
+    if isinstance(state, dict):
+        return dict(state), {"structure": "dict"}
+    flat = {f"{i}.{k}": t for i, sd in enumerate(state) for k, t in sd.items()}
+    return flat, {"structure": "list", "num_modules": str(len(state))}
+
+
+def _unflatten(flat: dict[str, torch.Tensor], metadata: dict[str, str]) -> State:
+    if metadata["structure"] == "dict":
+        return flat
+    state: list[dict[str, torch.Tensor]] = [
+        {} for _ in range(int(metadata["num_modules"]))
+    ]
+    for key, t in flat.items():
+        i, k = key.split(".", 1)
+        state[int(i)][k] = t
+    return state
+
+
+def snapshot(state: State) -> tuple[dict[str, torch.Tensor], dict[str, str]]:
+    """
+    Copies the tensors of a state to host memory, so that training can go on while
+    they are written. Tensors sharing memory (e.g. tied embeddings) are copied
+    once, and recorded as aliases in the returned safetensors metadata.
+    """
+    flat, metadata = _flatten(state)
+    tensors: dict[str, torch.Tensor] = {}
+    aliases: dict[str, str] = {}
+    seen: dict[tuple, str] = {}
+    for key, t in flat.items():
+        t = t.detach()
+        view = (t.device, t.data_ptr(), t.dtype, tuple(t.shape), t.stride())
+        if view in seen:
+            aliases[key] = seen[view]
+            continue
+        seen[view] = key
+        tensors[key] = t.to("cpu", copy=True).contiguous()
+    metadata.update(format=CHECKPOINT_FORMAT, aliases=json.dumps(aliases))
+    return tensors, metadata
+
+
+def write_snapshot(tensors: dict[str, torch.Tensor], metadata: dict[str, str], path):
+    # written to a temporary file first, so that a partial checkpoint is never seen
+    # under its final name
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    save_file(tensors, tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint(state: State, path: str):
+    write_snapshot(*snapshot(state), path)
+
+
+def load_checkpoint(path: str, like: Optional[State] = None) -> State:
+    """
+    Loads a checkpoint written by save_checkpoint or CheckpointWriter (memory-mapped),
+    or a legacy .bin checkpoint written with torch.save.
+
+    Parameters:
+    like: The current state of the model. If given, loaded tensors are moved to the
+        devices of the corresponding tensors of this state.
+    """
+    if not path.endswith(".safetensors"):
+        return torch.load(path)
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        metadata = json.loads(f.read(header_size))["__metadata__"]
+    assert (
+        metadata.get("format") == CHECKPOINT_FORMAT
+    ), f"Unknown checkpoint format {metadata.get('format')}"
+    flat = load_file(path)
+    for key, target in json.loads(metadata["aliases"]).items():
+        flat[key] = flat[target]
+    if like is not None:
+        devices = {k: t.device for k, t in _flatten(like)[0].items()}
+        flat = {k: t.to(devices.get(k, t.device)) for k, t in flat.items()}
+    return _unflatten(flat, metadata)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints in a background thread. Tensors are copied to host memory
+    when a checkpoint is submitted, and written as safetensors files while training
+    goes on. Deletions go through the same queue, so that files are removed after
+    the writes submitted before them. Errors of the thread are raised by the next
+    call.
+    """
+
+    def __init__(self):
+        self.queue: queue.Queue = queue.Queue()
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                if self.error is None:
+                    task()
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state: State, path: str):
+        self._check()
+        tensors, metadata = snapshot(state)
+        self.queue.put(lambda: write_snapshot(tensors, metadata, path))
+
+    def remove(self, path: str):
+        self._check()
+        self.queue.put(lambda: os.remove(path))
+
+    def wait(self):
+        """Waits until all submitted writes and deletions are done"""
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
@@ -1,10 +1,13 @@
 import gc
+import os
 
 import torch
 from transformers import AutoTokenizer
 
 import pynvml
 
+from weak_to_strong.device import device_count
+
 
 def to_batch(x, batch_size: int, start: int = 0, end: int | None = None):
     """Helper function to split a dataset into batches,
@@ -39,10 +42,12 @@ def clear_mem(verbose: bool = False):
     """
 
     gc.collect()
-    torch.cuda.empty_cache()
-    print(
-        f"torch.cuda.memory_allocated: {torch.cuda.memory_allocated(0) / 1024**3:.2f}GB"
-    )
+    if device_count() > 0:
+        torch.cuda.empty_cache()
+        print(
+            "torch.cuda.memory_allocated: "
+            f"{torch.cuda.memory_allocated(0) / 1024**3:.2f}GB"
+        )
 
     if verbose:
 
@@ -72,3 +77,11 @@ def get_gpu_mem_used() -> float:
     finally:
         pynvml.nvmlShutdown()
     return prop_sum / num_devices
+
+
+def get_mem_used() -> float:
+    """returns proportion of used GPU memory averaged across all GPUs, or of used
+    host memory when running on CPU"""
+    if device_count() > 0:
+        return get_gpu_mem_used()
+    return 1 - os.sysconf("SC_AVPHYS_PAGES") / os.sysconf("SC_PHYS_PAGES")
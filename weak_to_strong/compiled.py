@@ -0,0 +1,47 @@
+import time
+
+import torch
+
+
+class CompiledModel(torch.nn.Module):
+    """
+    Runs the forward pass of a model compiled with torch.compile, with static shapes.
+    Each new input shape (and train/eval mode) compiles a new graph, so inputs
+    should come in few distinct shapes, e.g. collated with pad_to_bucket.
+
+    The model is kept in the `module` attribute (as with DataParallel), so that code
+    unwrapping models to save or inspect them works unchanged. Counts of compiled
+    and reused shapes, and the time spent in calls that compiled a graph, are kept
+    in `stats`.
+    """
+
+    def __init__(self, module: torch.nn.Module):
+        super().__init__()
+        self.module = module
+        self.compiled_forward = torch.compile(module.forward, dynamic=False)
+        self.shapes: set = set()
+        self.stats = {"compiled_shapes": 0, "reused_shapes": 0, "compile_time": 0.0}
+
+    @property
+    def device(self):
+        return self.module.device
+
+    def forward(self, *args, **kwargs):
+        key = (
+            self.module.training,
+            torch.is_grad_enabled(),
+            tuple(
+                (name, tuple(v.shape)) if isinstance(v, torch.Tensor) else (name, v)
+                for name, v in list(enumerate(args)) + sorted(kwargs.items())
+                if not isinstance(v, (tuple, list))
+            ),
+        )
+        if key in self.shapes:
+            self.stats["reused_shapes"] += 1
+            return self.compiled_forward(*args, **kwargs)
+        self.shapes.add(key)
+        start = time.time()
+        output = self.compiled_forward(*args, **kwargs)
+        self.stats["compiled_shapes"] += 1
+        self.stats["compile_time"] += time.time() - start
+        return output
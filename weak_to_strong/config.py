@@ -3,6 +3,7 @@ from typing import Optional
 
 import yaml
 
+from weak_to_strong.device import device_count, get_device_memory, is_bf16_supported
 from weak_to_strong.loss import logconf_loss_fn, product_loss_fn, xent_loss, kl_loss
 
 
@@ -95,8 +96,9 @@ class ModelConfig:
         assert name is not None
         memory = float(memory)
         custom_kwargs = custom_kwargs or {}
-        per_device_ram = torch.cuda.get_device_properties(0).total_memory
-        n_devices = torch.cuda.device_count()
+        # on CPU, the memory of the host and no devices to parallelize over
+        per_device_ram = get_device_memory()
+        n_devices = device_count()
         if torch_dtype is not None:
             assert custom_kwargs.get("torch_dtype") is None
             custom_kwargs["torch_dtype"] = {
@@ -106,7 +108,7 @@ class ModelConfig:
         else:
             custom_kwargs["torch_dtype"] = torch.bfloat16
         if (
-            not torch.cuda.is_bf16_supported() or lora_modules is None
+            not is_bf16_supported() or lora_modules is None
         ) and custom_kwargs[  # we enforce fp32 for full finetuning
             "torch_dtype"
         ] == torch.bfloat16:
@@ -3,21 +3,28 @@ from dataclasses import dataclass
 from random import Random
 from typing import Any, Callable, Optional
 import hashlib
+import inspect
+import json
+import os
+import shutil
+import weakref
+
+import numpy as np
 
 from datasets import (
     Dataset as HfDataset,
     DatasetDict as HfDatasetDict,
+    IterableDatasetDict as HfIterableDatasetDict,
     load_dataset as hf_load_dataset,
     concatenate_datasets,
 )
 
-from collections import Counter
-
 
 @dataclass
 class DatasetConfig:
     # split -> unshuffled dataset of items
-    loader: Callable[[str], HfDataset]
+    # also takes a `streaming` keyword, in which case it returns an IterableDataset
+    loader: Callable[..., HfDataset]
     # formats items to have keys 'txt' and 'hard_label', takes a random.Random rng
     # optionally also adds the key 'choices', a pair of strings, indicating to use the lm head
     formatter: Callable[[Any], Any]
@@ -34,25 +41,82 @@ def register_dataset(name: str, config: DatasetConfig):
 def balance(ds: HfDataset, seed: int):
     """Undersample balance to 50/50"""
 
-    label_counts = Counter(ds["hard_label"])
-    assert len(label_counts) == 2, "Dataset must be binary"
+    labels = np.asarray(ds["hard_label"])
+    label_values, first_seen, counts = np.unique(
+        labels, return_index=True, return_counts=True
+    )
+    assert len(label_values) == 2, "Dataset must be binary"
 
     # undersample the majority class
-    majority_label = max(label_counts, key=lambda k: label_counts[k])
-    minority_label = 1 - majority_label
-    minority_count = label_counts[minority_label]
-    minority_ds = ds.filter(lambda ex: ex["hard_label"] == minority_label)
-    majority_ds = (
-        ds.filter(lambda ex: ex["hard_label"] == majority_label)
-        .shuffle(seed=seed)
-        .select(range(minority_count))
-    )
-    return concatenate_datasets([minority_ds, majority_ds]).shuffle(seed=seed)
+    # (ties go to the label seen first, as with max() over a Counter)
+    majority = max(range(2), key=lambda i: (counts[i], -first_seen[i]))
+    majority_label = label_values[majority]
+    minority_count = counts[1 - majority]
+    minority_idx = np.flatnonzero(labels != majority_label)
+    majority_idx = np.flatnonzero(labels == majority_label)
+    # these permutations are the ones used by HF's Dataset.shuffle(seed=seed)
+    majority_idx = majority_idx[
+        np.random.default_rng(seed).permutation(len(majority_idx))
+    ][:minority_count]
+    balanced_idx = np.concatenate([minority_idx, majority_idx])
+    balanced_idx = balanced_idx[
+        np.random.default_rng(seed).permutation(len(balanced_idx))
+    ]
+    return ds.select(balanced_idx)
+
+
+def _add_id_and_soft_label(batch):
+    return {
+        "id": [hashlib.sha1(txt.encode()).hexdigest()[:8] for txt in batch["txt"]],
+        "soft_label": [
+            [1 - float(label), float(label)] for label in batch["hard_label"]
+        ],
+    }
+
+
+def _load_streaming(
+    cfg: DatasetConfig,
+    split: str,
+    n_docs: Optional[int],
+    seed: int,
+    shuffle_buffer_size: Optional[int],
+) -> HfDataset:
+    """
+    Reads only the first `n_docs` records of a streamed split (after a seeded
+    buffered shuffle if `shuffle_buffer_size` is set) and formats them as they
+    arrive, so that only the formatted fields of the records we need are ever
+    held in memory.
+    """
+    ds = cfg.loader(split, streaming=True)
+    if shuffle_buffer_size is not None:
+        ds = ds.shuffle(seed=seed, buffer_size=shuffle_buffer_size)
+    if n_docs is not None:
+        ds = ds.take(n_docs)
+    rng = Random(seed)
+    records = [cfg.formatter(ex, rng=rng) for ex in ds]  # type: ignore
+    if n_docs is not None and len(records) < n_docs:
+        print(f"Warning {split} has less than {n_docs} docs, using all {len(records)}")
+    return HfDataset.from_list(records)
 
 
 def load_and_process_dataset(
-    ds_name: str, seed: int = 0, split_sizes: Optional[dict] = None
+    ds_name: str,
+    seed: int = 0,
+    split_sizes: Optional[dict] = None,
+    streaming: bool = False,
+    shuffle_buffer_size: Optional[int] = None,
 ):
+    """
+    Loads, formats and balances the splits of a registered dataset, and adds
+    ids and soft labels.
+
+    If `streaming` is True, splits are streamed and only as many records as
+    requested by `split_sizes` are read, instead of loading (and for `n_test`
+    loaders, concatenating and splitting) the whole dataset first. Without a
+    `shuffle_buffer_size`, this yields the same examples as non-streaming loading,
+    except for `n_test` loaders, whose test set is then taken from a seeded buffered
+    shuffle rather than from `train_test_split`.
+    """
     if split_sizes is None:
         split_sizes = dict(train=None, test=None)
 
@@ -61,21 +125,19 @@ def load_and_process_dataset(
     cfg = _REGISTRY[ds_name]
     results = {}
     for split, n_docs in split_sizes.items():
-        ds = cfg.loader(split)
-        try:
-            ds = ds.select(range(n_docs))
-        except IndexError:
-            print(f"Warning {ds_name} has less than {n_docs} docs, using all {len(ds)}")
-        ds = balance(
-            ds.map(functools.partial(cfg.formatter, rng=Random(seed))),  # type: ignore
-            seed,
-        )
-        ds = ds.map(
-            lambda ex: {
-                "id": hashlib.sha1(ex["txt"].encode()).hexdigest()[:8],
-                "soft_label": [1 - float(ex["hard_label"]), float(ex["hard_label"])],
-            }
-        )
+        if streaming:
+            ds = _load_streaming(cfg, split, n_docs, seed, shuffle_buffer_size)
+        else:
+            ds = cfg.loader(split)
+            try:
+                ds = ds.select(range(n_docs))
+            except IndexError:
+                print(
+                    f"Warning {ds_name} has less than {n_docs} docs, using all {len(ds)}"
+                )
+            ds = ds.map(functools.partial(cfg.formatter, rng=Random(seed)))  # type: ignore
+        ds = balance(ds, seed)
+        ds = ds.map(_add_id_and_soft_label, batched=True)
         ds = ds.shuffle(seed=seed)  # shuffling a bit pointless for test set but wtv
         results[split] = ds
     return results
@@ -83,8 +145,20 @@ def load_and_process_dataset(
 
 warned_about_choices = set()
 
+# tokenizer -> {choice text -> token id}
+_choice_ids_cache: "weakref.WeakKeyDictionary[Any, dict[str, int]]" = (
+    weakref.WeakKeyDictionary()
+)
+
 
 def encode_choice(text, tokenizer):
+    cache = _choice_ids_cache.setdefault(tokenizer, {})
+    if text not in cache:
+        cache[text] = _encode_choice(text, tokenizer)
+    return cache[text]
+
+
+def _encode_choice(text, tokenizer):
     global warned_about_choices
 
     c_ids = tokenizer.encode(text, add_special_tokens=False)
@@ -110,6 +184,7 @@ def tokenize_dataset(
     raw_ds: HfDataset,
     tokenizer: Callable,
     max_ctx: int,
+    num_proc: Optional[int] = None,
 ):
     """
     This function prepares the dataset for training. It takes the raw dataset,
@@ -119,52 +194,194 @@ def tokenize_dataset(
     raw_ds: The raw dataset to be processed.
     tokenizer: The tokenizer to be used on the formatted dataset.
     max_ctx: The maximum context length for the tokenizer.
+    num_proc: The number of processes to tokenize with.
 
     Returns:
     ds: The processed and shuffled dataset ready for training.
     """
 
-    def process_function(ex):
-        toks = tokenizer(ex["txt"])
-        out = dict(
-            input_ids=toks["input_ids"],
-        )
+    def process_function(batch):
+        input_ids = tokenizer(batch["txt"])["input_ids"]
+        # drop examples that are too long
+        lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+        keep = np.flatnonzero(lengths < max_ctx)
+        out = {k: [v[i] for i in keep] for k, v in batch.items()}
+        out["input_ids"] = [input_ids[i] for i in keep]
 
-        if "choices" in ex:
-            choice_toks = [encode_choice(c, tokenizer) for c in ex["choices"]]
-            out["choice_input_ids"] = choice_toks
+        if "choices" in batch:
+            out["choice_input_ids"] = [
+                [encode_choice(c, tokenizer) for c in batch["choices"][i]] for i in keep
+            ]
 
         return out
 
-    ds = raw_ds.map(process_function, batched=False)
-    pre_len = len(ds)
-    ds = ds.filter(lambda x: len(x["input_ids"]) < max_ctx)
+    pre_len = len(raw_ds)
+    ds = raw_ds.map(
+        process_function,
+        batched=True,
+        remove_columns=raw_ds.column_names,
+        num_proc=num_proc,
+    )
     print(
         f"Filtered {100 * (1 - len(ds) / pre_len):.2f}% of examples for being too long"
     )
     return ds
 
 
-def hf_loader(*hf_name, split_names=None, n_test=None):
+# bump this whenever processing or tokenization changes, to invalidate old caches
+DATASET_CACHE_VERSION = 1
+
+
+def _global_values(code, globals_: dict) -> str:
+    """The constant (e.g. int or str) module globals used by a code object, or the
+    functions it defines"""
+    values = ""
+    for name in code.co_names:
+        value = globals_.get(name)
+        if isinstance(value, (bool, int, float, str, bytes)):
+            values += f"{name}={value!r};"
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            values += _global_values(const, globals_)
+    return values
+
+
+def _source(fn: Callable) -> str:
+    """The source code of a function, with the arguments of partials, and the values
+    it closes over and the constant globals it uses"""
+    if isinstance(fn, functools.partial):
+        return _source(fn.func) + repr((fn.args, sorted(fn.keywords.items())))
+    # e.g. functools.lru_cache wrappers
+    fn = inspect.unwrap(fn)
+    try:
+        source = inspect.getsource(fn)
+    except (OSError, TypeError):
+        source = getattr(fn, "__qualname__", repr(fn))
+    if hasattr(fn, "__code__"):
+        source += _global_values(fn.__code__, fn.__globals__)
+    for cell in getattr(fn, "__closure__", None) or []:
+        value = cell.cell_contents
+        source += _source(value) if callable(value) else repr(value)
+    return source
+
+
+def dataset_source_hash(ds_name: str) -> str:
+    """
+    Returns a hash of the code the splits of a dataset are built with: its loader
+    (and the arguments of hf_loader) and formatter, and the processing functions of
+    this module. It belongs in the key of load_cached_splits, so that editing this
+    code invalidates cached splits.
+    """
+    cfg = _REGISTRY[ds_name]
+    h = hashlib.sha1()
+    h.update(repr(getattr(cfg.loader, "hf_args", None)).encode())
+    for fn in [
+        cfg.loader,
+        cfg.formatter,
+        _load_streaming,
+        load_and_process_dataset,
+        balance,
+        _add_id_and_soft_label,
+        tokenize_dataset,
+        _encode_choice,
+    ]:
+        h.update(_source(fn).encode())
+    return h.hexdigest()
+
+
+def load_cached_splits(
+    cache_dir: Optional[str],
+    key: dict,
+    build_fn: Callable[[], dict[str, HfDataset]],
+) -> dict[str, HfDataset]:
+    """
+    Returns the dataset splits built by `build_fn`, caching them on disk.
+
+    The cache is content-addressed: `key` should contain everything the splits
+    depend on (dataset name, seed, split sizes, tokenizer, max_ctx, and the
+    dataset_source_hash of the code building them...), so that
+    any run with the same key, including other jobs of a sweep, reuses the same
+    Arrow files. Splits are written to a temporary directory which is then
+    atomically renamed, so concurrent jobs never read a partial cache entry.
+
+    Parameters:
+    cache_dir: The directory holding the cache. If None, caching is disabled.
+    key: A JSON-serializable dict identifying the splits.
+    build_fn: A function building the splits on a cache miss.
+    """
+    if cache_dir is None:
+        return build_fn()
+
+    key_json = json.dumps(
+        dict(key, cache_version=DATASET_CACHE_VERSION), sort_keys=True
+    )
+    path = os.path.join(cache_dir, hashlib.sha1(key_json.encode()).hexdigest())
+    if not os.path.exists(path):
+        splits = build_fn()
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        HfDatasetDict(splits).save_to_disk(tmp_path)
+        with open(os.path.join(tmp_path, "cache_key.json"), "w") as f:
+            f.write(key_json)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another job wrote the same cache entry in the meantime
+            shutil.rmtree(tmp_path)
+    else:
+        print(f"Loading cached dataset splits from {path}")
+    return dict(HfDatasetDict.load_from_disk(path))
+
+
+# buffer size of the shuffle used to take the test set of `n_test` loaders
+# when streaming
+STREAMING_TEST_SHUFFLE_BUFFER_SIZE = 10_000
+
+
+def hf_loader(*hf_name, split_names=None, n_test=None, **load_kwargs):
     """
     If `split_names` is provided, it maps from the requested
     split name to the actual name in the hugginface dataset.
     If `n_test` is provided, it will concatenate all splits together
     and then take a deterministic test set of size `n_test` from it.
+    Other keyword arguments are passed to `datasets.load_dataset`, e.g.
+    `hf_loader("json", data_files=...)` to load local files.
+
+    The returned loader takes a split name and a `streaming` keyword.
     """
     if n_test is not None:
         assert split_names is None
-        ds = hf_load_dataset(*hf_name)
-        if isinstance(ds, HfDatasetDict):
-            ds = concatenate_datasets(ds.values())  # type: ignore
-        assert isinstance(ds, HfDataset)
-        splits = ds.train_test_split(test_size=n_test, seed=0)
-        return lambda split: splits[split]
 
-    if split_names is None:
-        split_names = dict()
+        @functools.lru_cache(maxsize=None)
+        def load_splits(streaming: bool):
+            ds = hf_load_dataset(*hf_name, streaming=streaming, **load_kwargs)
+            if isinstance(ds, (HfDatasetDict, HfIterableDatasetDict)):
+                ds = concatenate_datasets(list(ds.values()))  # type: ignore
+            if streaming:
+                ds = ds.shuffle(seed=0, buffer_size=STREAMING_TEST_SHUFFLE_BUFFER_SIZE)
+                return dict(train=ds.skip(n_test), test=ds.take(n_test))
+            assert isinstance(ds, HfDataset)
+            return ds.train_test_split(test_size=n_test, seed=0)
+
+        loader = lambda split, streaming=False: load_splits(streaming)[split]
+    else:
+        if split_names is None:
+            split_names = dict()
+
+        loader = lambda split, streaming=False: hf_load_dataset(
+            *hf_name,
+            split=split_names.get(split, split),
+            streaming=streaming,
+            **load_kwargs,
+        )
 
-    return lambda split: hf_load_dataset(*hf_name, split=split_names.get(split, split))
+    # hashed by dataset_source_hash
+    loader.hf_args = (  # type: ignore
+        hf_name,
+        split_names,
+        n_test,
+        sorted(load_kwargs.items()),
+    )
+    return loader
 
 
 ##########
@@ -0,0 +1,117 @@
+import contextlib
+import functools
+import os
+from typing import Optional
+
+import torch
+
+# whether forward passes of bf16 models on CPU run under bf16 autocast (if the CPU
+# supports bf16)
+_cpu_autocast = False
+
+
+def get_device() -> torch.device:
+    """Returns the device models are placed on: the first GPU if any, else the CPU"""
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def device_count() -> int:
+    """Returns the number of GPUs, or 0 when running on CPU"""
+    return torch.cuda.device_count() if torch.cuda.is_available() else 0
+
+
+@functools.lru_cache()
+def _cpu_flags() -> set[str]:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def is_bf16_supported(device: Optional[torch.device] = None) -> bool:
+    """
+    Whether bf16 is supported natively: by the GPU, or on CPU by AVX512-BF16 or
+    AMX instructions (without which bf16 matmuls are emulated, and slower than fp32).
+    """
+    device = device or get_device()
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    return bool(_cpu_flags() & {"avx512_bf16", "amx_bf16"})
+
+
+def set_cpu_autocast(enabled: bool):
+    global _cpu_autocast
+    _cpu_autocast = enabled
+
+
+def weights_dtype(model: torch.nn.Module) -> torch.dtype:
+    """
+    Returns the dtype of the transformer of a TransformerWithHead, possibly wrapped
+    (e.g. by DistributedDataParallel in .module, or MultiAdapterModel in .model)
+    """
+    while not hasattr(model, "transformer"):
+        model = model.module if hasattr(model, "module") else model.model
+    return model.transformer.dtype
+
+
+def autocast_dtype(
+    device, dtype: Optional[torch.dtype] = None
+) -> Optional[torch.dtype]:
+    """Returns the dtype autocast(device, dtype) runs ops in, or None if it is a no-op"""
+    # DataParallel models are given the index of their output GPU
+    device = torch.device("cuda", device) if isinstance(device, int) else device
+    device = torch.device(device)
+    if (
+        _cpu_autocast
+        and dtype == torch.bfloat16
+        and device.type == "cpu"
+        and is_bf16_supported(device)
+    ):
+        return torch.bfloat16
+    return None
+
+
+def autocast(
+    device, dtype: Optional[torch.dtype] = None
+) -> contextlib.AbstractContextManager:
+    """
+    Returns a bf16 autocast context for forward passes of models loaded in bf16
+    (`dtype`, see weights_dtype) on CPUs that support bf16, if enabled with
+    set_cpu_autocast, and a no-op context otherwise. Models loaded in fp32 (e.g. for
+    full fine-tuning, see ModelConfig) always run in fp32. On GPU, models are
+    loaded in the dtype chosen by ModelConfig instead.
+    """
+    if autocast_dtype(device, dtype) is not None:
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def set_num_threads(
+    num_threads: Optional[int] = None, num_interop_threads: Optional[int] = None
+):
+    """
+    Sets the number of threads used within (num_threads) and across
+    (num_interop_threads) CPU ops. The latter can only be set before the first
+    parallel op of the process, so later changes are ignored with a warning.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if (
+        num_interop_threads is not None
+        and num_interop_threads != torch.get_num_interop_threads()
+    ):
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            print(f"Could not set the number of interop threads: {e}")
+
+
+def get_device_memory() -> int:
+    """Returns the memory of a GPU, or the physical memory of the host on CPU"""
+    if device_count() > 0:
+        return torch.cuda.get_device_properties(0).total_memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
@@ -0,0 +1,94 @@
+import os
+from typing import Any
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def init_distributed() -> bool:
+    """
+    Initializes the default process group when launched with torchrun (i.e. with
+    WORLD_SIZE > 1 in the environment), with the nccl backend on GPUs and gloo on
+    CPU, and selects the GPU of the local rank. Returns whether training is
+    distributed.
+    """
+    if int(os.environ.get("WORLD_SIZE", "1")) <= 1:
+        return False
+    if not dist.is_initialized():
+        if torch.cuda.is_available():
+            torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", "0")))
+        dist.init_process_group("nccl" if torch.cuda.is_available() else "gloo")
+    return True
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """Whether this process writes results, checkpoints and logs"""
+    return get_rank() == 0
+
+
+def get_local_device() -> torch.device:
+    if torch.cuda.is_available():
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def shard(indices: np.ndarray) -> np.ndarray:
+    """
+    Returns the contiguous part of indices processed by this process. All processes
+    get the same number of indices (the remainder is dropped), so that they run
+    the same number of forward and backward passes.
+    """
+    per_rank = len(indices) // get_world_size()
+    return indices[get_rank() * per_rank : (get_rank() + 1) * per_rank]
+
+
+def all_reduce_sum(value: float, device) -> float:
+    if not is_distributed():
+        return value
+    t = torch.tensor(value, dtype=torch.float64, device=device)
+    dist.all_reduce(t)
+    return t.item()
+
+
+def all_reduce_mean(t: torch.Tensor) -> torch.Tensor:
+    """Averages a tensor over all processes, in place"""
+    if is_distributed():
+        dist.all_reduce(t)
+        t /= get_world_size()
+    return t
+
+
+def all_gather_cat(t: torch.Tensor) -> torch.Tensor:
+    """Concatenates a tensor of the same shape from every process, by rank"""
+    if not is_distributed():
+        return t
+    gathered = [torch.empty_like(t) for _ in range(get_world_size())]
+    dist.all_gather(gathered, t.contiguous())
+    return torch.cat(gathered)
+
+
+def all_gather_objects(obj: Any) -> list:
+    """Returns the objects of every process, by rank"""
+    if not is_distributed():
+        return [obj]
+    gathered: list = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
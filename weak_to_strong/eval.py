@@ -1,10 +1,25 @@
+import time
 from typing import Optional
 import datasets
 import numpy as np
 import torch
 from torch import nn
 from sklearn.metrics import roc_auc_score
+from weak_to_strong.batching import (
+    TokenizedArrays,
+    bucketed_batches,
+    padding_efficiency,
+    token_budget_batches,
+)
 from weak_to_strong.common import to_batch
+from weak_to_strong.device import autocast, weights_dtype
+from weak_to_strong.distributed import (
+    all_gather_objects,
+    get_rank,
+    get_world_size,
+    is_distributed,
+)
+from weak_to_strong.model import expand_prefix_cache
 
 
 def unpack(x):
@@ -12,6 +27,23 @@ def unpack(x):
     return x.detach().float().cpu().numpy().tolist()
 
 
+def model_inputs(batch: dict[str, torch.Tensor], device) -> dict[str, torch.Tensor]:
+    """Returns the tensors of a collated batch that are inputs of the model, on
+    the given device"""
+    return {
+        k: batch[k].to(device)
+        for k in [
+            "input_ids",
+            "attention_mask",
+            "position_ids",
+            "example_ends",
+            "features",
+            "choice_input_ids",
+        ]
+        if k in batch
+    }
+
+
 def eval_loop(
     model: nn.Module,
     ds: datasets.Dataset,
@@ -19,88 +51,218 @@ def eval_loop(
     verbose: bool = True,
     metric_prefix: Optional[str] = None,
     remove_large_columns: bool = False,
-) -> tuple[datasets.Dataset, dict[str, float]]:
+    bucket_by_length: bool = False,
+    max_tokens: Optional[int] = None,
+    arrays: Optional[TokenizedArrays] = None,
+    pack_length: Optional[int] = None,
+    cache_prefix: bool = False,
+    head_names: Optional[list[str]] = None,
+    pad_to_bucket: bool = False,
+) -> tuple:
     """
     This function evaluates the accuracy of a given model on a given dataset.
 
     Parameters:
     model (nn.Module): The model to be evaluated.
     ds (datasets.Dataset): The dataset on which the model is to be evaluated.
+    bucket_by_length (bool): Whether to batch examples of similar length together
+        to reduce padding. All examples are then evaluated (including the last
+        partial batch), and results are returned in the original dataset order.
+    max_tokens (int, optional): If set, batches are formed so that their number of
+        rows times their padded length is at most max_tokens, instead of having
+        eval_batch_size rows. As with bucket_by_length, all examples are evaluated.
+    arrays (TokenizedArrays, optional): ds converted with
+        TokenizedArrays.from_dataset, to avoid converting it at every call. If
+        the arrays hold features, only the head of the model is run.
+    pack_length (int, optional): If set, the examples of each batch are packed
+        into rows of up to pack_length tokens, see TokenizedArrays.collate_packed.
+    cache_prefix (bool): Whether to run the tokens shared by the beginning of all
+        examples (e.g. the instructions of a prompt template) only once, and reuse
+        their key-value cache for every batch. Not used with pack_length.
+    head_names (list, optional): The names of the heads of a model with several
+        heads, used as metric prefixes. Defaults to head0, head1...
+    pad_to_bucket (bool): Whether to pad batches to lengths in a few buckets (see
+        batching.bucket_length), for compiled models.
 
     Returns:
     results (list): A list of dictionaries containing the input_ids, ground truth label,
                     predicted label, accuracy of prediction, logits and soft label for
                     each example in the dataset.
     metrics (dict): A dictionary containing summary metrics for logging (e.g. AUROC).
+    If the model has several heads, results is a dict from head name to results, and
+    metrics are prefixed with {metric_prefix}/{head name}.
     """
 
     model.eval()
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        # every process runs its share of the batches with its own replica
+        model = model.module
+    assert pack_length is None or not isinstance(
+        model, nn.DataParallel
+    ), "packed rows can't be split across devices"
+    if arrays is None:
+        arrays = TokenizedArrays.from_dataset(ds)
+    device = model.device if hasattr(model, "device") else "cpu"
 
     with torch.no_grad():
-        results = []
-        # for ex in ds:
-        for batch in to_batch(ds, eval_batch_size):
-            # pad input_ids to common length
-            input_ids = torch.nn.utils.rnn.pad_sequence(
-                [torch.tensor(ex) for ex in batch["input_ids"]], batch_first=True
-            ).to(model.device if hasattr(model, "device") else "cpu")
-            soft_labels = batch["soft_label"]
-
-            # run forward pass
-            raw_logits = model(
-                input_ids, choice_input_ids=batch.get("choice_input_ids")
+        if max_tokens is not None or bucket_by_length:
+            lengths = arrays.lengths
+            if max_tokens is not None:
+                batches = token_budget_batches(lengths, max_tokens)
+            else:
+                batches = bucketed_batches(
+                    lengths, eval_batch_size, megabatch_factor=None
+                )
+            if verbose:
+                print(
+                    "\tpadding efficiency: "
+                    f"{padding_efficiency(lengths, batches):.3f}"
+                )
+        else:
+            batches = list(to_batch(np.arange(len(ds)), eval_batch_size))
+        if is_distributed():
+            # all processes must call eval_loop, and get the results of all batches
+            batches = batches[get_rank() :: get_world_size()]
+
+        start = time.time()
+        prefix_length, prefix_cache = 0, None
+        if cache_prefix and pack_length is None and arrays.features is None:
+            prefix_length = arrays.common_prefix_length()
+        if prefix_length > 0:
+            unwrapped = model.module if hasattr(model, "module") else model
+            prefix_ids = torch.from_numpy(
+                arrays.tokens[:prefix_length].astype(np.int64)
             )
+            prefix_cache = unwrapped.prefix_cache(prefix_ids.to(unwrapped.device))
+            if verbose:
+                print(f"\treusing the cache of a {prefix_length}-token shared prefix")
+
+        all_logits = []
+        dtype = weights_dtype(model)
+        for batch_idx in batches:
+            if pack_length is not None:
+                batch = arrays.collate_packed(batch_idx, pack_length)
+            else:
+                batch = arrays.collate(
+                    batch_idx, skip=prefix_length, pad_to_bucket=pad_to_bucket
+                )
+            inputs = model_inputs(batch, device)
+            if prefix_cache is not None:
+                inputs["past_key_values"] = expand_prefix_cache(
+                    prefix_cache, len(batch_idx)
+                )
 
-            raw_logprobs = torch.nn.functional.log_softmax(raw_logits, dim=-1)
-            hard_labels = np.argmax(soft_labels, axis=-1)
-            logprobs = unpack(raw_logprobs)
-            preds = np.argmax(logprobs, axis=-1)
-            r = {
-                "id": batch["id"],
-                "txt": batch["txt"],
-                "input_ids": batch["input_ids"],
-                "hard_label": hard_labels,
-                "soft_label": soft_labels,
-                "hard_pred": preds,
-                "soft_pred": unpack(raw_logprobs.exp()),
-                "acc": preds == hard_labels,
-                "logit": unpack(raw_logits),
-                "logprob": logprobs,
-            }
-            if remove_large_columns:
-                del r["input_ids"]
-                del r["txt"]
-            if "weak_soft_label" in batch:
-                r["weak_soft_label"] = batch["weak_soft_label"]
-            results.extend([dict(zip(r, t)) for t in zip(*r.values())])
-
-        # compute metrics
-        soft_labels, pred_probs = (
-            np.array([r["soft_label"] for r in results])[:, 1],
-            np.array([r["soft_pred"] for r in results])[:, 1],
-        )
-
-        # if the current evaluation is weak to strong
+            # run forward pass
+            with autocast(device, dtype):
+                raw_logits = model(**inputs)
+            all_logits.append(raw_logits.detach().float().cpu())
+
+        if is_distributed():
+            # collect the batches of all processes (some of which may have none)
+            gathered = all_gather_objects((batches, all_logits))
+            batches = [b for process_batches, _ in gathered for b in process_batches]
+            all_logits = [x for _, process_logits in gathered for x in process_logits]
+
+        # put the predictions back in dataset order
+        positions = np.concatenate(batches)
+        if verbose:
+            n_tokens = arrays.num_tokens(positions)
+            print(f"\t{n_tokens / (time.time() - start):.0f} tokens/sec")
+        order = np.argsort(positions, kind="stable")
+        positions = positions[order]
+        raw_logits = torch.cat(all_logits)[torch.from_numpy(order)]
+
+        columns = ["id", "soft_label"]
+        if not remove_large_columns:
+            columns += ["txt", "input_ids"]
         if "weak_soft_label" in ds.column_names:
-            # these are predictions from the weak supervisor on the eval set
-            # we loaded in `train_simple.py`
-            weak_soft_labels = np.array(ds["weak_soft_label"])[:, 1]
-            # truncate away the last partial batch
-            weak_soft_labels = weak_soft_labels[: len(pred_probs)]
-        else:
-            weak_soft_labels = None
-        metrics = compute_metrics(
-            gt_soft_labels=soft_labels,
-            pred_probs=pred_probs,
-            weak_soft_labels=weak_soft_labels,
-            metric_prefix=metric_prefix,
-        )
+            columns.append("weak_soft_label")
+        if len(positions) < len(ds):
+            ds = ds.select(positions)
+        batch = ds.select_columns(columns)[:]
+
+        if raw_logits.dim() == 2:
+            results, metrics = results_and_metrics(
+                batch, raw_logits, remove_large_columns, metric_prefix
+            )
+        else:  # several heads
+            if head_names is None:
+                head_names = [f"head{k}" for k in range(raw_logits.shape[1])]
+            results, metrics = {}, {}
+            for k, name in enumerate(head_names):
+                results[name], head_metrics = results_and_metrics(
+                    batch,
+                    raw_logits[:, k],
+                    remove_large_columns,
+                    f"{metric_prefix}/{name}" if metric_prefix else name,
+                )
+                metrics.update(head_metrics)
 
         if verbose:
             for k, v in metrics.items():
                 print(f"\t{k}: {v:.3f}")
 
-        return datasets.Dataset.from_list(results), metrics
+        return results, metrics
+
+
+def results_and_metrics(
+    batch: dict,
+    raw_logits: torch.Tensor,
+    remove_large_columns: bool = False,
+    metric_prefix: Optional[str] = None,
+) -> tuple[datasets.Dataset, dict[str, float]]:
+    """
+    Builds the results and metrics of eval_loop from the logits of a single head.
+
+    Parameters:
+    batch (dict): The id, soft_label, txt, input_ids and weak_soft_label columns of
+        the evaluated examples (the last three are optional).
+    raw_logits (torch.Tensor): The [n, num_labels] logits of the examples.
+    """
+    raw_logprobs = torch.nn.functional.log_softmax(raw_logits, dim=-1)
+    soft_labels = batch["soft_label"]
+    hard_labels = np.argmax(soft_labels, axis=-1)
+    logprobs = unpack(raw_logprobs)
+    preds = np.argmax(logprobs, axis=-1)
+    results = {
+        "id": batch["id"],
+        "txt": batch.get("txt"),
+        "input_ids": batch.get("input_ids"),
+        "hard_label": hard_labels.tolist(),
+        "soft_label": soft_labels,
+        "hard_pred": preds.tolist(),
+        "soft_pred": unpack(raw_logprobs.exp()),
+        "acc": (preds == hard_labels).tolist(),
+        "logit": unpack(raw_logits),
+        "logprob": logprobs,
+    }
+    if remove_large_columns:
+        del results["input_ids"]
+        del results["txt"]
+    if "weak_soft_label" in batch:
+        results["weak_soft_label"] = batch["weak_soft_label"]
+
+    # compute metrics
+    soft_labels, pred_probs = (
+        np.array(soft_labels)[:, 1],
+        np.array(results["soft_pred"])[:, 1],
+    )
+
+    # if the current evaluation is weak to strong
+    if "weak_soft_label" in batch:
+        # these are predictions from the weak supervisor on the eval set
+        # we loaded in `train_simple.py`
+        weak_soft_labels = np.array(batch["weak_soft_label"])[:, 1]
+    else:
+        weak_soft_labels = None
+    metrics = compute_metrics(
+        gt_soft_labels=soft_labels,
+        pred_probs=pred_probs,
+        weak_soft_labels=weak_soft_labels,
+        metric_prefix=metric_prefix,
+    )
+
+    return datasets.Dataset.from_dict(results), metrics
 
 
 def compute_metrics(
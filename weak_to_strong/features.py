@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+from typing import Optional
+
+import datasets
+import numpy as np
+import torch
+
+from weak_to_strong.batching import (
+    TokenizedArrays,
+    bucketed_batches,
+    token_budget_batches,
+)
+from weak_to_strong.device import autocast, autocast_dtype, weights_dtype
+
+FEATURE_CACHE_VERSION = 2
+
+
+def _unwrap(model: torch.nn.Module) -> torch.nn.Module:
+    return model.module if hasattr(model, "module") else model
+
+
+def extract_features(
+    model: torch.nn.Module,
+    arrays: TokenizedArrays,
+    eval_batch_size: int,
+    max_tokens: Optional[int] = None,
+    out: Optional[np.ndarray] = None,
+    dtype: str = "float32",
+) -> np.ndarray:
+    """
+    Runs the transformer of the model once over all examples and returns the hidden
+    states at their last token, i.e. the inputs of the linear head.
+
+    Parameters:
+    model: A TransformerWithHead with a learned head (possibly wrapped by
+        DataParallel).
+    arrays: The tokenized examples.
+    eval_batch_size: The number of examples per forward pass.
+    max_tokens: If set, batches are formed by a budget of (padded) tokens instead,
+        as in eval_loop.
+    out: An array of shape [n, hidden_size] to write the features to (e.g. a
+        memory-mapped file). If None, a new array is allocated.
+    dtype: The dtype of the allocated array.
+
+    Returns:
+    The [n, hidden_size] array of features, in the order of `arrays`.
+    """
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        # every process extracts all the features, to train its replica of the head
+        model = model.module
+    score = _unwrap(model).score
+    assert score is not None, "features are only used with a learned head"
+    if out is None:
+        out = np.empty((len(arrays), score.in_features), dtype=dtype)
+    lengths = arrays.lengths
+    if max_tokens is not None:
+        batches = token_budget_batches(lengths, max_tokens)
+    else:
+        batches = bucketed_batches(lengths, eval_batch_size, megabatch_factor=None)
+
+    model.eval()
+    device = model.device if hasattr(model, "device") else 0
+    with torch.no_grad():
+        for batch_idx in batches:
+            batch = arrays.collate(batch_idx)
+            with autocast(device, weights_dtype(model)):
+                hidden_states = model(
+                    batch["input_ids"].to(device),
+                    attention_mask=batch["attention_mask"].to(device),
+                    return_features=True,
+                )
+            out[batch_idx] = hidden_states.float().cpu().numpy()
+    return out
+
+
+def add_features(
+    model: torch.nn.Module,
+    ds: datasets.Dataset,
+    eval_batch_size: int,
+    max_tokens: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    dtype: str = "float32",
+) -> TokenizedArrays:
+    """
+    Converts ds to TokenizedArrays holding the features of the model for every
+    example, so that the head of a linear probe can be trained and evaluated
+    without running the transformer again.
+
+    Features are cached in `cache_dir` as memory-mapped .npy files, keyed by the
+    model name and the tokens of the examples, so that later runs probing the
+    same model on the same examples (e.g. with other learning rates or number of
+    epochs) skip the transformer entirely. If `cache_dir` is None, features are
+    kept in memory.
+    """
+    arrays = TokenizedArrays.from_dataset(ds)
+    if cache_dir is None:
+        arrays.features = extract_features(
+            model, arrays, eval_batch_size, max_tokens, dtype=dtype
+        )
+        return arrays
+
+    unwrapped = _unwrap(model)
+    key = hashlib.sha1(
+        json.dumps(
+            dict(
+                model=unwrapped.config._name_or_path,
+                dtype=dtype,
+                # the features also depend on how the transformer is run
+                model_dtype=str(weights_dtype(model)),
+                attn_implementation=getattr(
+                    unwrapped.transformer.config, "_attn_implementation", None
+                ),
+                autocast=str(autocast_dtype(unwrapped.device, weights_dtype(model))),
+                cache_version=FEATURE_CACHE_VERSION,
+            ),
+            sort_keys=True,
+        ).encode()
+    )
+    key.update(arrays.tokens.tobytes())
+    key.update(arrays.offsets.tobytes())
+    path = os.path.join(cache_dir, f"{key.hexdigest()}.npy")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}.npy"
+        out = np.lib.format.open_memmap(
+            tmp_path,
+            mode="w+",
+            dtype=dtype,
+            shape=(len(arrays), _unwrap(model).score.in_features),
+        )
+        extract_features(model, arrays, eval_batch_size, max_tokens, out=out)
+        out.flush()
+        del out
+        # another job may have written the same features in the meantime, in which
+        # case they are identical
+        os.replace(tmp_path, path)
+    else:
+        print(f"Loading cached features from {path}")
+    arrays.features = np.load(path, mmap_mode="r")
+    return arrays
@@ -4,6 +4,8 @@ from typing import Optional
 
 import wandb
 
+from weak_to_strong.distributed import is_main_process
+
 
 def append_to_jsonl(path: str, data: dict):
     with open(path, "a") as f:
@@ -20,12 +22,16 @@ class WandbLogger(object):
         save_path: str,
         wandb_args: dict,
     ):
+        self._log_dict = {}
+        if not is_main_process():
+            # only the main process of distributed runs logs
+            wandb.init(**{**wandb_args, "mode": "disabled"})
+            return
         wandb.init(**wandb_args)
 
         self.log_path = os.path.join(save_path, "log.jsonl")
         if not os.path.exists(save_path):
             os.makedirs(save_path)
-        self._log_dict = {}
 
     def logkv(self, key, value):
         self._log_dict[key] = value
@@ -33,6 +39,10 @@ class WandbLogger(object):
     def logkvs(self, d):
         self._log_dict.update(d)
 
+    def popkvs(self) -> dict:
+        d, self._log_dict = self._log_dict, {}
+        return d
+
     def dumpkvs(self):
         wandb.log(self._log_dict)
         if self.log_path is not None:
@@ -69,6 +79,12 @@ def logkvs(d):
     WandbLogger.CURRENT.logkvs(d)  # type: ignore
 
 
+def popkvs() -> dict:
+    """Returns and clears the values logged since the last dump, without dumping them"""
+    assert is_configured(), "WandbLogger is not configured"
+    return WandbLogger.CURRENT.popkvs()  # type: ignore
+
+
 def dumpkvs():
     assert is_configured(), "WandbLogger is not configured"
     WandbLogger.CURRENT.dumpkvs()  # type: ignore
@@ -1,3 +1,7 @@
+import copy
+import itertools
+import sys
+from collections import OrderedDict
 from dataclasses import dataclass
 
 import torch
@@ -6,6 +10,91 @@ from peft import get_peft_model, LoraConfig, TaskType, PeftType  # type: ignore
 from peft.tuners.lora.layer import LoraLayer
 from typing import Optional
 
+from weak_to_strong.checkpoint import save_checkpoint
+
+
+# model types whose attention takes position_ids and (with _allow_4d_masks) a 4D
+# attention mask, which sequence packing relies on
+PACKING_MODEL_TYPES = ("llama", "mistral", "mixtral", "qwen2")
+
+
+def _allow_4d_masks(transformer: torch.nn.Module):
+    """
+    Up to transformers 4.37, models build their 4D attention mask from a 2D one in
+    _prepare_4d_causal_attention_mask(_for_sdpa). This makes these functions pass
+    4D (additive) masks through unchanged, as later versions do.
+    """
+    module = sys.modules[type(transformer).__module__]
+    for name in [
+        "_prepare_4d_causal_attention_mask",
+        "_prepare_4d_causal_attention_mask_for_sdpa",
+    ]:
+        prepare = getattr(module, name, None)
+        if prepare is None or getattr(prepare, "allows_4d_masks", False):
+            continue
+
+        def prepare_4d(attention_mask, *args, _prepare=prepare, **kwargs):
+            if attention_mask is not None and attention_mask.dim() == 4:
+                return attention_mask
+            return _prepare(attention_mask, *args, **kwargs)
+
+        prepare_4d.allows_4d_masks = True  # type: ignore
+        setattr(module, name, prepare_4d)
+
+
+# pristine base models kept on the CPU by load_base_model, most recently used last
+_BASE_MODEL_CACHE: "OrderedDict[tuple, torch.nn.Module]" = OrderedDict()
+_base_model_cache_bytes = 0
+
+
+def set_base_model_cache_size(max_bytes: int):
+    """
+    Sets the byte budget of the process-level cache of base models used by
+    load_base_model (0, the default, disables it), evicting the least recently
+    used models beyond it.
+    """
+    global _base_model_cache_bytes
+    _base_model_cache_bytes = max_bytes
+    _evict_base_models(max_bytes)
+
+
+def _model_bytes(model: torch.nn.Module) -> int:
+    return sum(
+        t.numel() * t.element_size()
+        for t in itertools.chain(model.parameters(), model.buffers())
+    )
+
+
+def _evict_base_models(max_bytes: int):
+    while _BASE_MODEL_CACHE and (
+        sum(map(_model_bytes, _BASE_MODEL_CACHE.values())) > max_bytes
+    ):
+        _BASE_MODEL_CACHE.popitem(last=False)
+
+
+def load_base_model(name: str, **kwargs) -> PreTrainedModel:
+    """
+    Returns AutoModelForCausalLM.from_pretrained(name, **kwargs). If a cache budget
+    is set with set_base_model_cache_size, a pristine copy of the model is kept on
+    the CPU, and later calls with the same arguments (e.g. the runs of a sweep in
+    one process) return a copy of it instead of reading the weights from disk again.
+    Models placed with a device_map are never cached.
+    """
+    if _base_model_cache_bytes <= 0 or kwargs.get("device_map") is not None:
+        return AutoModelForCausalLM.from_pretrained(name, **kwargs)
+    key = (name, repr(sorted(kwargs.items())))
+    if key in _BASE_MODEL_CACHE:
+        print(f"Copying cached base model {name}")
+        _BASE_MODEL_CACHE.move_to_end(key)
+        return copy.deepcopy(_BASE_MODEL_CACHE[key])
+    model = AutoModelForCausalLM.from_pretrained(name, **kwargs)
+    if _model_bytes(model) <= _base_model_cache_bytes:
+        # the cached model is never returned, so that LoRA layers, heads and
+        # training never modify it
+        _BASE_MODEL_CACHE[key] = copy.deepcopy(model)
+        _evict_base_models(_base_model_cache_bytes)
+    return model
+
 
 @dataclass
 class HeadOutput:
@@ -17,6 +106,11 @@ class TransformerWithHead(PreTrainedModel):
     This class initializes the linear head to zeros
     """
 
+    # attention is implemented by self.lm, which checks that it supports the
+    # requested attn_implementation
+    _supports_flash_attn_2 = True
+    _supports_sdpa = True
+
     def __init__(
         self,
         name,
@@ -26,6 +120,9 @@ class TransformerWithHead(PreTrainedModel):
         lora_rank=8,
         lora_alpha=8,
         lora_dropout=0.0,
+        # number of independent learned heads, trained on the same transformer
+        # outputs (e.g. with different losses); only for linear probes
+        num_heads=1,
         **kwargs,
     ):
         config = AutoConfig.from_pretrained(name, **kwargs)
@@ -33,7 +130,7 @@ class TransformerWithHead(PreTrainedModel):
         self.num_labels = config.num_labels
         self.use_lm_head = use_lm_head
         self.lora_modules = lora_modules
-        self.lm = AutoModelForCausalLM.from_pretrained(name, **kwargs)
+        self.lm = load_base_model(name, **kwargs)
 
         if lora_modules is not None:
             print(f"Using LoraModel on modules {lora_modules}")
@@ -65,10 +162,20 @@ class TransformerWithHead(PreTrainedModel):
                 getattr(config, "n_embd", getattr(config, "hidden_size", None)),
             )
             assert isinstance(hidden_size, int)
-            self.score = torch.nn.Linear(hidden_size, self.num_labels, bias=False).to(
-                lm_head.weight.dtype
-            )
+            # the heads are stacked in a single linear layer
+            self.score = torch.nn.Linear(
+                hidden_size, self.num_labels * num_heads, bias=False
+            ).to(lm_head.weight.dtype)
             torch.nn.init.normal_(self.score.weight, std=0.0)
+            # the learned head replaces the LM head, which gets no gradients (DDP
+            # requires all trainable parameters to get some), unless it is tied to
+            # the input embeddings
+            if lm_head.weight is not self.lm.get_input_embeddings().weight:
+                lm_head.requires_grad_(False)
+        assert num_heads == 1 or (
+            linear_probe and not use_lm_head
+        ), "Several heads are only supported for linear probes with learned heads"
+        self.num_heads = num_heads
         self.linear_probe = linear_probe
 
     @property
@@ -90,13 +197,15 @@ class TransformerWithHead(PreTrainedModel):
             save_modules.append(self.score)
         return save_modules
 
-    def save_state_dict(self, path):
+    def state_to_save(self):
         if self.lora_modules is None:
-            save_dict_or_list = self.state_dict()
-        else:
-            # only save lora parameters
-            save_dict_or_list = [m.state_dict() for m in self.modules_to_save]
-        torch.save(save_dict_or_list, path)
+            return self.state_dict()
+        # only save lora parameters
+        return [m.state_dict() for m in self.modules_to_save]
+
+    def save_state_dict(self, path):
+        """Writes the state to save as a safetensors checkpoint (see load_checkpoint)"""
+        save_checkpoint(self.state_to_save(), path)
 
     def load_state_dict(self, state_dict, strict=True, assign=True):
         if self.lora_modules is None:
@@ -116,39 +225,161 @@ class TransformerWithHead(PreTrainedModel):
 
     def forward(
         self,
-        input_ids: torch.LongTensor,
+        input_ids: Optional[torch.LongTensor] = None,
         choice_input_ids: Optional[torch.LongTensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        example_ends: Optional[torch.LongTensor] = None,
+        past_key_values: Optional[tuple] = None,
+        features: Optional[torch.Tensor] = None,
+        return_features: bool = False,
     ):
         """
         Forward pass of the model with a linear head.
 
         Parameters:
-        input_ids (torch.LongTensor): Input tensor containing the token ids.
+        input_ids (torch.LongTensor): Input tensor containing the token ids,
+            right-padded.
+        attention_mask (torch.LongTensor, optional): 1 on real tokens and 0 on
+            padding. If None, tokens with id 0 are treated as padding. With
+            attn_implementation="flash_attention_2", padding is removed before
+            attention (variable-length kernels), so that attention compute scales
+            with the number of real tokens.
+        position_ids, example_ends (torch.LongTensor, optional): Given for packed
+            rows of several examples, see TokenizedArrays.collate_packed, with a 4D
+            attention_mask.
+        past_key_values (tuple, optional): The cache of a prefix shared by all
+            examples, as returned by prefix_cache and expanded to the batch size
+            with expand_prefix_cache. input_ids and attention_mask then only hold
+            the tokens after the prefix.
+        features (torch.Tensor, optional): The hidden states at the last token of
+            each example, as returned with return_features. If given, the
+            transformer is skipped and only the head is applied.
+        return_features (bool): Whether to return the hidden states at the last
+            token instead of the logits.
 
         Returns:
-        HeadOutput: Output dataclass containing the logits.
+        HeadOutput: Output dataclass containing the logits. With several heads,
+            logits are of shape [batch_size, num_heads, num_labels].
         """
-        input_lens = (input_ids != 0).sum(dim=-1)
-
         if self.score is None:  # use LM head
             assert choice_input_ids is not None
-            all_logits = self.lm(input_ids).logits
-            logits_at_last = [
-                all_logits[i, input_lens[i] - 1, choice_input_ids[i]]
-                for i in range(len(input_lens))
-            ]  # [batch_size, num_choices]
-            logits = torch.stack(logits_at_last)
-        else:  # use learned head
-            transformer_outputs = self.transformer(input_ids)
-            hidden_states = torch.stack(
-                [
-                    transformer_outputs[0][i, input_lens[i] - 1, :]
-                    for i in range(len(input_lens))
-                ]
+            assert features is None, "features are only used with a learned head"
+            # only compute the logits of the choices at the last token, rather than
+            # the whole vocabulary at every position
+            hidden_states = self.last_hidden_states(
+                input_ids, attention_mask, position_ids, example_ends, past_key_values
             )
+            lm_head = self.lm.get_output_embeddings()
+            if isinstance(lm_head, LoraLayer):
+                logits = lm_head(hidden_states)
+                logits = logits.gather(-1, choice_input_ids.to(logits.device))
+            else:
+                choice_input_ids = choice_input_ids.to(lm_head.weight.device)
+                logits = torch.einsum(
+                    "bh,bch->bc",
+                    hidden_states.to(lm_head.weight.device),
+                    lm_head.weight[choice_input_ids],
+                )  # [batch_size, num_choices]
+                if lm_head.bias is not None:
+                    logits = logits + lm_head.bias[choice_input_ids]
+        else:  # use learned head
+            if features is None:
+                hidden_states = self.last_hidden_states(
+                    input_ids,
+                    attention_mask,
+                    position_ids,
+                    example_ends,
+                    past_key_values,
+                )
+            else:
+                hidden_states = features.to(self.score.weight.dtype)
+            if return_features:
+                return hidden_states
             self.score.to(hidden_states.device)
             if self.linear_probe:
                 hidden_states = hidden_states.detach()
             logits = self.score(hidden_states)
+            if self.num_heads > 1:
+                # [batch_size, num_heads, num_labels]
+                logits = logits.view(len(logits), self.num_heads, self.num_labels)
 
         return logits
+
+    def last_hidden_states(
+        self,
+        input_ids: torch.LongTensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        example_ends: Optional[torch.LongTensor] = None,
+        past_key_values: Optional[tuple] = None,
+    ) -> torch.Tensor:
+        """
+        Returns the final hidden states of the transformer at the last non-padding
+        token of each example, of shape [batch_size, hidden_size].
+        """
+        if example_ends is not None:  # packed rows
+            assert self.config.model_type in PACKING_MODEL_TYPES, (
+                f"Packing is not supported for {self.config.model_type} models, "
+                f"only for {PACKING_MODEL_TYPES}"
+            )
+            assert (
+                getattr(self.config, "_attn_implementation", None)
+                != "flash_attention_2"
+            ), "Packing requires eager or sdpa attention"
+            _allow_4d_masks(self.transformer)
+            # the additive mask must have the dtype of the queries
+            dtype = (
+                torch.get_autocast_cpu_dtype()
+                if torch.is_autocast_cpu_enabled()
+                else self.transformer.dtype
+            )
+            attention_mask = torch.zeros(
+                attention_mask.shape, dtype=dtype, device=attention_mask.device
+            ).masked_fill(~attention_mask.bool(), torch.finfo(dtype).min)
+            hidden_states = self.transformer(
+                input_ids, attention_mask=attention_mask, position_ids=position_ids
+            )[0]
+            return hidden_states.flatten(0, 1)[example_ends.to(hidden_states.device)]
+
+        if attention_mask is None:
+            attention_mask = (input_ids != 0).long()
+        if past_key_values is None:
+            hidden_states = self.transformer(input_ids, attention_mask=attention_mask)[
+                0
+            ]
+        else:
+            # values are [..., prefix_length, head_dim] for all models
+            prefix_length = past_key_values[0][1].shape[-2]
+            prefix_mask = attention_mask.new_ones(len(attention_mask), prefix_length)
+            hidden_states = self.transformer(
+                input_ids,
+                attention_mask=torch.cat([prefix_mask, attention_mask], dim=1),
+                past_key_values=past_key_values,
+            )[0]
+        last = attention_mask.sum(dim=-1).to(hidden_states.device) - 1
+        return hidden_states[torch.arange(len(last), device=last.device), last]
+
+    def prefix_cache(self, prefix_ids: torch.LongTensor) -> tuple:
+        """
+        Runs the transformer on a prefix shared by all examples, and returns its
+        past key values (as a tuple of per-layer tuples, with a batch size of 1).
+        """
+        past_key_values = self.transformer(
+            prefix_ids[None], use_cache=True
+        ).past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        return past_key_values
+
+
+def expand_prefix_cache(past_key_values: tuple, batch_size: int) -> tuple:
+    """Repeats the prefix cache of prefix_cache for every example of a batch"""
+
+    def expand(t):
+        if t.shape[0] == 1:
+            return t.expand(batch_size, *t.shape[1:])
+        # e.g. bloom's [batch_size * num_heads, ...] layout
+        return t.repeat(batch_size, *[1] * (t.dim() - 1))
+
+    return tuple(tuple(expand(t) for t in layer) for layer in past_key_values)
@@ -0,0 +1,63 @@
+from typing import Optional
+
+import torch
+from transformers.pytorch_utils import Conv1D
+
+from weak_to_strong.device import get_device
+from weak_to_strong.model import TransformerWithHead
+
+
+def check_quantization_device(device: Optional[torch.device] = None):
+    """
+    Raises a ValueError if models on `device` (by default, the device models are
+    placed on) can't be quantized for inference, which is only supported on CPU.
+    To be called before training, rather than finding out after it.
+    """
+    device = device or get_device()
+    if device.type != "cpu":
+        raise ValueError(
+            f"quantize_inference only runs on CPU (int8 dynamic quantization), but "
+            f"models are on {device}"
+        )
+
+
+def _conv1d_to_linear(module: torch.nn.Module):
+    """Replaces the Conv1D layers of GPT-2 style models by equivalent Linear layers"""
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            # Conv1D weights are [in_features, out_features]
+            linear = torch.nn.Linear(*child.weight.shape, dtype=child.weight.dtype)
+            linear.weight.data = child.weight.data.T.contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+
+
+def quantize_for_inference(model: torch.nn.Module) -> TransformerWithHead:
+    """
+    Prepares a trained model for faster inference on CPU, in place: LoRA weights are
+    merged into the base weights, and the linear layers of the transformer are
+    dynamically quantized to int8 (weights are stored in int8, and activations are
+    quantized on the fly). The LM head and learned head are kept in float32.
+
+    The returned model can't be trained or saved with save_state_dict anymore.
+    """
+    model = model.module if hasattr(model, "module") else model
+    assert isinstance(model, TransformerWithHead)
+    check_quantization_device(model.device)
+    if model.lora_modules is not None:
+        model.lm = model.lm.merge_and_unload()
+        model.lora_modules = None
+    model.float()
+    _conv1d_to_linear(model.transformer)
+    torch.ao.quantization.quantize_dynamic(
+        model.transformer, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+    # quantized layers take float32 inputs, while other ops may run in bf16 under
+    # autocast on CPU
+    for m in model.transformer.modules():
+        if isinstance(m, torch.ao.nn.quantized.dynamic.Linear):
+            m.register_forward_pre_hook(lambda m, args: (args[0].float(), *args[1:]))
+    model.eval()
+    return model
@@ -1,7 +1,10 @@
+import contextlib
+import functools
+import itertools
 import os
 import pickle
 import time
-from typing import Callable, Optional
+from typing import Callable, Optional, Union
 
 import datasets
 import numpy as np
@@ -10,22 +13,82 @@ import torch_optimizer as toptim
 from transformers import get_linear_schedule_with_warmup
 
 import weak_to_strong.logger as logger
-from weak_to_strong.common import to_batch, get_gpu_mem_used
-from weak_to_strong.eval import eval_loop, compute_metrics
+from weak_to_strong.batching import (
+    Prefetcher,
+    TokenizedArrays,
+    bucketed_batches,
+    padding_efficiency,
+    sequential_batches,
+)
+from weak_to_strong.checkpoint import CheckpointWriter, load_checkpoint
+from weak_to_strong.common import to_batch, get_mem_used
+from weak_to_strong.compiled import CompiledModel
+from weak_to_strong.device import autocast, device_count, get_device, weights_dtype
+from weak_to_strong.distributed import (
+    all_gather_cat,
+    all_reduce_mean,
+    all_reduce_sum,
+    barrier,
+    get_local_device,
+    get_world_size,
+    is_distributed,
+    is_main_process,
+    shard,
+)
+from weak_to_strong.eval import eval_loop, model_inputs
+from weak_to_strong.features import add_features
 from weak_to_strong.loss import kl_loss
 from weak_to_strong.model import TransformerWithHead
+from weak_to_strong.quantize import check_quantization_device, quantize_for_inference
+from weak_to_strong.train_metrics import WindowedTrainMetrics
 from weak_to_strong.config import ModelConfig
 
 
-def save(
-    model: torch.nn.Module,
-    save_file: Optional[str],
-):
+def save(model: torch.nn.Module, save_file: str, writer: CheckpointWriter):
     # Note: If the model is wrapped by DataParallel, we need to unwrap it before saving
     model_to_save = model.module if hasattr(model, "module") else model
 
-    model_to_save.save_state_dict(save_file)
-    print("saved torch weights", save_file)
+    # the weights are copied to host memory and written in the background
+    writer.save(model_to_save.state_to_save(), save_file)
+    print("saving weights", save_file)
+
+
+def save_results(results, path: str):
+    """Saves eval results, which are a dict from head name to results if the model
+    has several heads"""
+    if isinstance(results, dict):
+        for name, head_results in results.items():
+            head_results.save_to_disk(os.path.join(path, name))
+    else:
+        results.save_to_disk(path)
+
+
+def clip_head_grad_norms(model: torch.nn.Module, num_heads: int, max_norm: float):
+    """
+    Clips the gradient norm of each head of a linear probe with several heads
+    separately (like clip_grad_norm_ would in separate runs), so that heads are
+    trained independently.
+    """
+    score = (model.module if hasattr(model, "module") else model).score
+    grad = score.weight.grad.view(num_heads, -1)
+    norms = torch.linalg.vector_norm(grad.float(), dim=1)
+    grad.mul_(torch.clamp(max_norm / (norms + 1e-6), max=1.0)[:, None].to(grad.dtype))
+
+
+def trainable_parameters(model: torch.nn.Module) -> dict[str, torch.Tensor]:
+    """The parameters updated by training: only the head of linear probes"""
+    model = model.module if hasattr(model, "module") else model
+    if model.linear_probe and model.score is not None:
+        return dict(model.score.named_parameters(prefix="score"))
+    return {name: p for name, p in model.named_parameters() if p.requires_grad}
+
+
+def to_host(*tensors: torch.Tensor) -> list[np.ndarray]:
+    """Copies tensors to host memory as float32 arrays, with a single transfer (and
+    device sync) for all of them"""
+    flat = torch.cat([t.detach().float().flatten() for t in tensors]).cpu().numpy()
+    splits = np.cumsum([t.numel() for t in tensors])[:-1]
+    return [x.reshape(t.shape) for x, t in zip(np.split(flat, splits), tensors)]
 
 
 def train_model(
@@ -33,7 +96,8 @@ def train_model(
     ds: datasets.Dataset,
     batch_size: int,
     lr: float = 1e-5,
-    loss_fn: Callable = kl_loss,
+    # with several heads, a dict from head name to the loss function of that head
+    loss_fn: Union[Callable, dict[str, Callable]] = kl_loss,
     print_every: int = 10,
     eval_every: Optional[int] = None,
     save_every: Optional[int] = None,
@@ -54,6 +118,39 @@ def train_model(
     metric_for_best_model: str = "eval/auroc_against_supervision",
     greater_is_better: bool = True,
     save_total_limit: Optional[int] = 1,
+    # group examples of similar length into the same batches to reduce padding,
+    # shuffling the order of batches with the given seed at every epoch
+    bucket_by_length: bool = False,
+    seed: int = 0,
+    # if set, eval batches hold at most this many (padded) tokens instead of
+    # eval_batch_size examples
+    eval_max_tokens: Optional[int] = None,
+    # if positive, this many minibatches are prepared ahead of time in a background
+    # thread (the order of examples is unchanged)
+    prefetch_depth: int = 0,
+    # if True, the transformer of a linear probe is run once over ds and eval_ds,
+    # and the head is trained and evaluated on the cached features
+    cache_features: bool = False,
+    # if set, features are saved to and reused from memory-mapped files in this
+    # directory (see features.add_features)
+    feature_cache_dir: Optional[str] = None,
+    feature_dtype: str = "float32",
+    # if set, the examples of each minibatch (and eval batch) are packed into rows of
+    # up to this many tokens, see TokenizedArrays.collate_packed
+    pack_length: Optional[int] = None,
+    # if True, evals reuse the key-value cache of the prefix shared by all examples
+    cache_prefix: bool = False,
+    # with load_best_model_at_end, the trainable parameters of the best model are
+    # kept in host memory (rather than loaded back from its checkpoint) if they take
+    # at most this many bytes, so that evals need not coincide with checkpoints
+    best_in_memory_max_bytes: int = 0,
+    # if True, forward passes run the model compiled with torch.compile, with
+    # sequence lengths padded to powers of two so that few graphs are compiled
+    compile_model: bool = False,
+    # the loss and batch accuracy are logged every step, while other train metrics
+    # (AUROC, calibration, etc.) are computed over the examples of this many steps,
+    # in a background thread
+    train_metrics_window: int = 1,
 ):
     """
     ds is a dataset of examples, each of which is a dict with keys:
@@ -61,26 +158,86 @@ def train_model(
     - soft_label: a list of soft label probabilities
     - choice_input_ids (optional): a pair of token ids for the answer choices,
         indicating to use the LM head of the model
+
+    When launched with torchrun, model is wrapped by DistributedDataParallel and
+    minibatch_size is per process: each process runs its own share of every batch,
+    and gradients are only synchronized at the last minibatch of each step. Only
+    the main process writes checkpoints and results, to a save_path that must be
+    shared by all processes.
     """
     print(
         f"LR: {lr}, batch size: {batch_size}, mbatch size: {minibatch_size}, n: {len(ds)}"
     )
+    is_ddp = isinstance(model, torch.nn.parallel.DistributedDataParallel)
+    assert is_ddp or not is_distributed(), "distributed training requires DDP"
+    world_size = get_world_size()
     assert (
-        batch_size % minibatch_size == 0
-    ), "batch size must be divisible by minibatch size"
+        batch_size % (minibatch_size * world_size) == 0
+    ), "batch size must be divisible by minibatch size (times the number of processes)"
 
     def checkpoint_name(step):
         assert (
             save_path is not None
         ), "save_path must not be None if save_every is not None"
-        return os.path.join(save_path, f"checkpoint_{step}.bin")
+        return os.path.join(save_path, f"checkpoint_{step}.safetensors")
 
     is_w2s = "gt_soft_label" in ds.features
+    if isinstance(loss_fn, dict):
+        head_names: Optional[list[str]] = list(loss_fn)
+        assert (
+            not load_best_model_at_end
+        ), "load_best_model_at_end is not supported with several heads"
+        # adafactor factorizes second moments across the rows of the stacked heads
+        assert (
+            optimizer_name.lower() == "adam"
+        ), "several heads are only trained independently with adam"
+        metric_prefixes = [f"train/{name}" for name in head_names]
+    else:
+        head_names = None
+        metric_prefixes = ["train"]
     if metric_for_best_model.endswith("_against_supervision"):
         metric_for_best_model = metric_for_best_model.replace(
             "_against_supervision", "_against_weak" if is_w2s else ""
         )
 
+    # convert the datasets once to flat arrays, from which minibatches are collated
+    if cache_features:
+        unwrapped = model.module if hasattr(model, "module") else model
+        assert (
+            unwrapped.linear_probe and unwrapped.score is not None
+        ), "cache_features requires a linear probe with a learned head"
+        assert not train_with_dropout, "cached features are computed without dropout"
+        print("Computing features for the linear probe")
+        arrays, eval_arrays = [
+            add_features(
+                model,
+                d,
+                eval_batch_size,
+                eval_max_tokens,
+                cache_dir=feature_cache_dir,
+                dtype=feature_dtype,
+            )
+            if d is not None
+            else None
+            for d in [ds, eval_ds]
+        ]
+    else:
+        arrays = TokenizedArrays.from_dataset(ds)
+        eval_arrays = (
+            TokenizedArrays.from_dataset(eval_ds) if eval_ds is not None else None
+        )
+
+    assert pack_length is None or not isinstance(
+        model, torch.nn.DataParallel
+    ), "packed rows can't be split across devices"
+    if compile_model:
+        assert pack_length is None, "packed rows have too many shapes to compile"
+        assert not isinstance(
+            model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)
+        ), "compiled models are not supported with DataParallel or DDP"
+    # the model run by forward passes
+    run_model = CompiledModel(model) if compile_model else model
+
     # we purposefully turn off dropout, for determinism
     # this seems to help for 1 epoch finetuning anyways
     model.train(mode=train_with_dropout)
@@ -119,9 +276,23 @@ def train_model(
     losses = []
     accuracies = []
     aurocs = []
+    windowed_metrics = WindowedTrainMetrics(train_metrics_window, metric_prefixes)
+    auroc_key = "auroc_against_weak" if is_w2s else "auroc"
     best_eval = float("-inf") if greater_is_better else float("inf")
     best_step = 0 if load_best_model_at_end else None
     ckpt_names = []
+    writer = CheckpointWriter() if save_every and is_main_process() else None
+    best_params: Optional[dict[str, torch.Tensor]] = None
+    best_in_memory = False
+    if load_best_model_at_end and best_in_memory_max_bytes > 0:
+        params_bytes = sum(
+            p.numel() * p.element_size() for p in trainable_parameters(model).values()
+        )
+        best_in_memory = params_bytes <= best_in_memory_max_bytes
+        print(
+            f"Keeping the best model's trainable parameters ({params_bytes} bytes) "
+            + ("in memory" if best_in_memory else "in checkpoints")
+        )
 
     def delete_old_checkpoints():
         if save_total_limit is None:
@@ -131,25 +302,32 @@ def train_model(
         to_delete = [
             name
             for name in ckpt_names[:-1]
-            if name != checkpoint_name(best_step) and name
+            if best_in_memory or name != checkpoint_name(best_step)
         ][:num_to_delete]
         for name in to_delete:
             ckpt_names.remove(name)
-            os.remove(name)
+            if writer is not None:
+                writer.remove(name)
 
     def update_best():
-        nonlocal best_eval, best_step
+        nonlocal best_eval, best_step, best_params
         if load_best_model_at_end:
             current_eval = eval_metrics[metric_for_best_model]
             if (greater_is_better and current_eval > best_eval) or (
                 not greater_is_better and current_eval < best_eval
             ):
-                assert os.path.exists(checkpoint_name(step)), (
-                    "No checkpoint found "
-                    "for the current step, "
-                    "but load_best_model_at_end was set to True and the current step is "
-                    "best. Please set save_every to a multiple of eval_every."
-                )
+                if best_in_memory:
+                    best_params = {
+                        name: p.detach().to("cpu", copy=True)
+                        for name, p in trainable_parameters(model).items()
+                    }
+                else:
+                    assert checkpoint_name(step) in ckpt_names, (
+                        "No checkpoint found "
+                        "for the current step, "
+                        "but load_best_model_at_end was set to True and the current step is "
+                        "best. Please set save_every to a multiple of eval_every."
+                    )
                 best_eval = current_eval
                 best_step = step
                 print(f"New best model found at step {step}")
@@ -157,16 +335,45 @@ def train_model(
     # If the model is wrapped by DataParallel, it doesn't have a device. In this case,
     # we use GPU 0 as the output device. This sadly means that this device will store
     # a bit more data than other ones, but hopefully should not be too big of a deal.
-    io_device = model.device if hasattr(model, "device") else 0
+    if is_ddp:
+        io_device = model.module.device
+    else:
+        io_device = model.device if hasattr(model, "device") else 0
+    model_dtype = weights_dtype(model)
 
+    lengths = arrays.lengths
     for epoch in range(epochs):
-        for start in range(0, len(ds), batch_size):
-            loss_tot = 0
+        if bucket_by_length:
+            batches = bucketed_batches(
+                lengths, batch_size, shuffle=True, seed=seed + epoch
+            )
+        else:
+            batches = sequential_batches(len(ds), batch_size)
+        # every process gets the same batches, and keeps its own share of each
+        mbatches = [list(to_batch(shard(b), minibatch_size)) for b in batches]
+        efficiency = padding_efficiency(lengths, [mb for b in mbatches for mb in b])
+        print(f"Epoch {epoch}: padding efficiency {efficiency:.3f}")
+        logger.logkv("train/padding_efficiency", efficiency)
+
+        all_mbatch_idx = [mb for b in mbatches for mb in b]
+        if pack_length is not None:
+            collate = functools.partial(arrays.collate_packed, max_length=pack_length)
+        else:
+            collate = functools.partial(arrays.collate, pad_to_bucket=compile_model)
+        if prefetch_depth > 0:
+            prefetcher = Prefetcher(
+                collate, all_mbatch_idx, prefetch_depth, device=io_device
+            )
+            mbatch_iter = iter(prefetcher)
+        else:
+            mbatch_iter = (collate(idx) for idx in all_mbatch_idx)
 
+        for batch_mbatches in mbatches:
             # save
             if save_every and step % save_every == 0 and save_every < nsteps:
                 ckpt_names.append(checkpoint_name(step))
-                save(model, ckpt_names[-1])
+                if writer is not None:
+                    save(model, ckpt_names[-1], writer)
                 delete_old_checkpoints()
 
             # eval
@@ -175,16 +382,23 @@ def train_model(
                     eval_ds is not None
                 ), "must provide eval_ds if eval_every is not None"
                 eval_results, eval_metrics = eval_loop(
-                    model,
+                    run_model,
                     eval_ds,
                     eval_batch_size,
                     metric_prefix="eval",
                     remove_large_columns=True,
+                    bucket_by_length=bucket_by_length,
+                    max_tokens=eval_max_tokens,
+                    arrays=eval_arrays,
+                    pack_length=pack_length,
+                    cache_prefix=cache_prefix,
+                    head_names=head_names,
+                    pad_to_bucket=compile_model,
                 )
                 logger.logkvs(eval_metrics)
-                if save_path is not None:
-                    eval_results.save_to_disk(
-                        os.path.join(save_path, f"eval_results_{step}")
+                if save_path is not None and is_main_process():
+                    save_results(
+                        eval_results, os.path.join(save_path, f"eval_results_{step}")
                     )
                 if gradient_checkpointing:
                     (
@@ -197,99 +411,158 @@ def train_model(
                 update_best()
 
             # train step
+            step_start = time.time()
             all_logits = []
             all_labels = []
-            for mbatch in to_batch(
-                ds, minibatch_size, start=start, end=start + batch_size
+            all_gt_labels = []
+            # losses stay on the device until the end of the step, to avoid syncs
+            loss_tot = torch.zeros((), device=io_device)
+            head_losses = torch.zeros(len(metric_prefixes), device=io_device)
+            for i, mbatch in enumerate(
+                itertools.islice(mbatch_iter, len(batch_mbatches))
             ):
-                input_ids = (
-                    torch.nn.utils.rnn.pad_sequence(
-                        [torch.tensor(ids) for ids in mbatch["input_ids"]]  # type: ignore
-                    )
-                    .transpose(0, 1)
-                    .to(io_device)  # type: ignore
-                )
-                labels = torch.tensor(mbatch["soft_label"]).to(io_device)  # type: ignore
-                logits = model(
-                    input_ids, choice_input_ids=mbatch.get("choice_input_ids")
-                ).to(io_device)
-                loss = loss_fn(logits, labels, step_frac=step / nsteps)
-                loss_tot += loss.item()
-                # we don't need to use a gradscaler because we're using bf16 instead of fp16
-                loss.backward()
-
-                all_logits.extend(logits)
-                all_labels.extend(labels)
+                # with DDP, gradients are only all-reduced after the last minibatch
+                sync = not is_ddp or i == len(batch_mbatches) - 1
+                labels = mbatch["soft_label"].to(io_device)
+                with contextlib.nullcontext() if sync else model.no_sync():
+                    with autocast(io_device, model_dtype):
+                        logits = run_model(**model_inputs(mbatch, io_device)).to(
+                            io_device
+                        )
+                    if head_names is None:
+                        loss = loss_fn(logits, labels, step_frac=step / nsteps)
+                    else:
+                        mbatch_head_losses = torch.stack(
+                            [
+                                fn(logits[:, k], labels, step_frac=step / nsteps)
+                                for k, fn in enumerate(loss_fn.values())
+                            ]
+                        )
+                        head_losses += mbatch_head_losses.detach() / len(batch_mbatches)
+                        loss = mbatch_head_losses.sum()
+                    # the loss of the step is the mean of its minibatch losses (and
+                    # DDP averages it over processes)
+                    loss = loss / len(batch_mbatches)
+                    loss_tot += loss.detach()
+                    # we don't need to use a gradscaler because we're using bf16 instead of fp16
+                    loss.backward()
+
+                all_logits.append(logits.detach())
+                all_labels.append(labels)
+                if is_w2s:
+                    all_gt_labels.append(mbatch["gt_soft_label"])
 
             if len(all_logits) == 0:
                 # skip batches too small to form a single minibatch
                 continue
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            if head_names is None:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            else:
+                clip_head_grad_norms(model, len(head_names), 1.0)
             optimizer.step()
             optimizer.zero_grad()
             lr_scheduler.step()
 
-            # train metrics
-            all_logits = torch.stack(all_logits)
-            all_labels = torch.stack(all_labels)
-            pred_probs = np.array(
-                torch.nn.functional.softmax(all_logits.detach().float().cpu(), dim=1)
-            )[:, 1]
-            supervision_soft_labels = np.array(all_labels.cpu())[:, 1]
+            # train metrics, over the examples of all processes
+            all_logits = all_gather_cat(torch.cat(all_logits).float())
+            all_labels = all_gather_cat(torch.cat(all_labels))
+            step_losses = all_reduce_mean(torch.cat([loss_tot[None], head_losses]))
+            # [batch_size] or [batch_size, num_heads]
+            pred_probs = torch.nn.functional.softmax(all_logits, dim=-1)[..., 1]
+            to_copy = [step_losses, pred_probs, all_labels[:, 1]]
+            if is_w2s:
+                gt_labels = all_gather_cat(torch.cat(all_gt_labels).to(io_device))
+                to_copy.append(gt_labels[:, 1])
+            # the only transfer of the step, which waits for it to finish
+            step_losses, pred_probs, supervision_soft_labels, *gt = to_host(*to_copy)
+            loss_tot, head_losses = float(step_losses[0]), step_losses[1:].tolist()
+            step_time = time.time() - step_start
 
             if is_w2s:
                 # then supervision labels are weak
-                gt_soft_labels = np.array(
-                    ds[start : start + len(pred_probs)]["gt_soft_label"]
-                )[:, 1]
+                gt_soft_labels = gt[0]
                 weak_soft_labels = supervision_soft_labels
             else:
                 gt_soft_labels = supervision_soft_labels
                 weak_soft_labels = None
 
-            train_metrics = compute_metrics(
-                gt_soft_labels=gt_soft_labels,
-                pred_probs=pred_probs,
-                weak_soft_labels=weak_soft_labels,
-                metric_prefix="train",
-            )
+            # [batch_size, num_heads]
+            head_probs = pred_probs.reshape(len(pred_probs), -1)
+
+            def head_accs(soft_labels):
+                return np.mean((head_probs > 0.5) == (soft_labels > 0.5)[:, None], 0)
+
+            # accuracies are logged every step, other metrics by windowed_metrics
+            train_metrics = {}
+            for k, prefix in enumerate(metric_prefixes):
+                train_metrics[f"{prefix}/acc"] = float(head_accs(gt_soft_labels)[k])
+                if is_w2s:
+                    train_metrics[f"{prefix}/acc_against_weak"] = float(
+                        head_accs(weak_soft_labels)[k]
+                    )
+                if head_names is not None:
+                    train_metrics[f"{prefix}/loss"] = head_losses[k]
 
-            # these three are printed every print_every steps
+            # these are printed every print_every steps, for each head, against the
+            # supervision labels (and the AUROCs of the windows computed meanwhile)
             losses.append(loss_tot)
-            accuracies.append(
-                train_metrics["train/acc_against_weak" if is_w2s else "train/acc"]
-            )
-            aurocs.append(
-                train_metrics["train/auroc_against_weak" if is_w2s else "train/auroc"]
-            )
+            accs = head_accs(supervision_soft_labels)
+            accuracies.append(accs[0] if head_names is None else accs)
 
+            # real (non-padding) tokens, measured up to the optimizer step
+            n_tokens = all_reduce_sum(
+                sum(arrays.num_tokens(mb) for mb in batch_mbatches), io_device
+            )
             train_metrics.update(
                 {
                     "step": step,
                     "progress": step / nsteps,
                     "loss": loss_tot,
                     "lr": lr_scheduler.get_last_lr()[0],
+                    "train/tokens": n_tokens,
+                    "train/tokens_per_second": n_tokens / step_time,
                 }
             )
             logger.logkvs(train_metrics)
+            # the row of the step is logged once the metrics of its window are added
+            windowed_metrics.add(
+                step, logger.popkvs(), pred_probs, gt_soft_labels, weak_soft_labels
+            )
+            for row in windowed_metrics.rows():
+                if f"{metric_prefixes[0]}/{auroc_key}" in row:
+                    aurocs.append([row[f"{p}/{auroc_key}"] for p in metric_prefixes])
+                logger.logkvs(row)
+                logger.dumpkvs()
 
             if print_every and step % print_every == 0:
+                # nan if no window was computed since the last print
+                auroc = np.mean(aurocs, axis=0) if aurocs else [np.nan] * len(accs)
                 print(
                     f"Step: {step}/{nsteps}; loss: {np.mean(losses)}; "
-                    f"train acc: {np.mean(accuracies)}; "
-                    f"train auroc: {np.mean(aurocs)}; ({len(losses)} losses)"
+                    f"train acc: {np.mean(accuracies, axis=0)}; "
+                    f"train auroc: {auroc[0] if head_names is None else auroc}; "
+                    f"({len(losses)} losses)"
                 )
                 losses = []
                 accuracies = []
                 aurocs = []
 
             step += 1
-            logger.dumpkvs()
+
+        if prefetch_depth > 0:
+            prefetcher.close()
+
+    # the rows of the last steps
+    for row in windowed_metrics.rows(wait=True):
+        logger.logkvs(row)
+        logger.dumpkvs()
+    windowed_metrics.close()
 
     # save final checkpoint
     if save_every and checkpoint_name(step) not in ckpt_names:
         ckpt_names.append(checkpoint_name(step))
-        save(model, ckpt_names[-1])
+        if writer is not None:
+            save(model, ckpt_names[-1], writer)
         delete_old_checkpoints()
 
     # final eval
@@ -298,17 +571,24 @@ def train_model(
         print("Final evaluation:")
         assert eval_ds is not None, "must provide eval_ds if eval_every is not None"
         final_eval_results, final_eval_metrics = eval_loop(
-            model,
+            run_model,
             eval_ds,
             eval_batch_size,
             metric_prefix="eval",
             remove_large_columns=False,
+            bucket_by_length=bucket_by_length,
+            max_tokens=eval_max_tokens,
+            arrays=eval_arrays,
+            pack_length=pack_length,
+            cache_prefix=cache_prefix,
+            head_names=head_names,
+            pad_to_bucket=compile_model,
         )
         logger.logkvs(final_eval_metrics)
         logger.dumpkvs()
-        if save_path is not None:
-            final_eval_results.save_to_disk(
-                os.path.join(save_path, "eval_results_final")
+        if save_path is not None and is_main_process():
+            save_results(
+                final_eval_results, os.path.join(save_path, "eval_results_final")
             )
         eval_metrics = final_eval_metrics
         update_best()
@@ -317,16 +597,37 @@ def train_model(
     if load_best_model_at_end and best_step != step:
         print(f"Loading best model from step {best_step}")
         assert best_step is not None
-        assert maybe_load_model(model, checkpoint_name(best_step)), (
-            "Failed to load " "the best model."
-        )
+        if best_in_memory:
+            assert best_params is not None, "Failed to load the best model."
+            with torch.no_grad():
+                for name, p in trainable_parameters(model).items():
+                    p.copy_(best_params[name])
+        else:
+            # the checkpoint is written by the main process
+            if writer is not None:
+                writer.wait()
+            barrier()
+            assert maybe_load_model(model, checkpoint_name(best_step)), (
+                "Failed to load " "the best model."
+            )
     if save_every:
         assert (
             save_path is not None
         ), "save_path must not be None if save_every is not None"
-        ckpt_names.append(os.path.join(save_path, "pytorch_model.bin"))
-        save(model, ckpt_names[-1])
-        delete_old_checkpoints()
+        ckpt_names.append(os.path.join(save_path, "model.safetensors"))
+        if writer is not None:
+            save(model, ckpt_names[-1], writer)
+            delete_old_checkpoints()
+            writer.close()
+
+    if compile_model:
+        stats = run_model.stats
+        print(
+            f"torch.compile: {stats['compiled_shapes']} shapes compiled in "
+            f"{stats['compile_time']:.1f}s, {stats['reused_shapes']} calls reused them"
+        )
+        logger.logkvs({f"compile/{k}": v for k, v in stats.items()})
+        logger.dumpkvs()
 
     print("done.")
     return final_eval_results, final_eval_metrics
@@ -334,9 +635,9 @@ def train_model(
 
 def maybe_load_model(model, checkpoint_path, disable=False):
     if os.path.exists(checkpoint_path) and not disable:
-        state_dict = torch.load(checkpoint_path)
-        (model.module if hasattr(model, "module") else model).load_state_dict(
-            state_dict
+        model = model.module if hasattr(model, "module") else model
+        model.load_state_dict(
+            load_checkpoint(checkpoint_path, like=model.state_to_save())
         )
         return True
     return False
@@ -354,7 +655,8 @@ def train_and_save_model(
     save_path: str,
     eval_batch_size: Optional[int] = None,
     minibatch_size_per_replica: Optional[int] = None,
-    loss_fn: Callable = kl_loss,
+    # with several heads, a dict from head name to loss function (see train_model)
+    loss_fn: Union[Callable, dict[str, Callable]] = kl_loss,
     force_retrain: bool = False,
     train_with_dropout: bool = False,
     linear_probe: bool = False,
@@ -366,28 +668,70 @@ def train_and_save_model(
     metric_for_best_model: str = "eval/auroc",
     greater_is_better: bool = True,
     save_total_limit: Optional[int] = 1,
+    bucket_by_length: bool = False,
+    seed: int = 0,
+    # per-device token budget for eval batches, see eval_loop
+    eval_max_tokens: Optional[int] = None,
+    prefetch_depth: int = 0,
+    cache_features: bool = False,
+    feature_cache_dir: Optional[str] = None,
+    feature_dtype: str = "float32",
+    pack_length: Optional[int] = None,
+    cache_prefix: bool = False,
+    best_in_memory_max_bytes: int = 0,
+    # make predictions on inference_ds with the model quantized to int8 (on CPU)
+    quantize_inference: bool = False,
+    compile_model: bool = False,
+    train_metrics_window: int = 1,
 ) -> tuple:
     if eval_batch_size is None:
         eval_batch_size = batch_size
 
     if minibatch_size_per_replica is None:
         minibatch_size_per_replica = 1
+    if quantize_inference and inference_ds:
+        check_quantization_device()
 
     # if the dataset has a "choice_input_ids" field, we use the LM head
     use_lm_head = "choice_input_ids" in train_ds.features
+    head_names = list(loss_fn) if isinstance(loss_fn, dict) else None
+    num_heads = 1 if head_names is None else len(head_names)
+    if cache_features and (use_lm_head or not linear_probe):
+        print("Not caching features, which are only used by linear probes")
+        cache_features = False
+
+    def feature_arrays(ds):
+        if not cache_features:
+            return None
+        return add_features(
+            model,
+            ds,
+            eval_batch_size,
+            eval_max_tokens,
+            cache_dir=feature_cache_dir,
+            dtype=feature_dtype,
+        )
 
     gradient_checkpointing = model_config.gradient_checkpointing
     custom_kwargs = model_config.custom_kwargs or {}
 
-    print(f"{get_gpu_mem_used() * 100:.2f}% of all GPU memory in use before training")
+    print(
+        f"{get_mem_used() * 100:.2f}% of all {'GPU' if device_count() else 'host'} "
+        "memory in use before training"
+    )
 
     already_trained = False
-    checkpoint_path = os.path.join(save_path, "pytorch_model.bin")
+    checkpoint_path = os.path.join(save_path, "model.safetensors")
+    legacy_checkpoint_path = os.path.join(save_path, "pytorch_model.bin")
+    if not os.path.exists(checkpoint_path) and os.path.exists(legacy_checkpoint_path):
+        # written with torch.save before checkpoints were saved as safetensors
+        checkpoint_path = legacy_checkpoint_path
     # Load the model
     if model_config.model_parallel:
         assert (
             torch.cuda.device_count() > 1
         ), f"you might want more gpus for {model_config.name}"
+        assert not is_distributed(), "model parallel is not supported with DDP"
         model = TransformerWithHead.from_pretrained(
             model_config.name,
             lora_modules=model_config.lora_modules,
@@ -395,6 +739,7 @@ def train_and_save_model(
             num_labels=2,
             device_map="auto",
             linear_probe=linear_probe,
+            num_heads=num_heads,
             **custom_kwargs,
         )
         already_trained = maybe_load_model(model, checkpoint_path, force_retrain)
@@ -406,18 +751,42 @@ def train_and_save_model(
             use_lm_head=use_lm_head,
             num_labels=2,
             linear_probe=linear_probe,
+            num_heads=num_heads,
             **custom_kwargs,
         ).to(
-            "cuda"  # type: ignore
+            get_local_device() if is_distributed() else get_device()  # type: ignore
         )
         already_trained = maybe_load_model(model, checkpoint_path, force_retrain)
+        if is_distributed():
+            # one process per device (or CPU process), launched by torchrun
+            if model.device.type == "cpu":
+                # gloo can't broadcast or all-reduce bf16 tensors, so replicas run
+                # in fp32 on CPU
+                model.float()
+            model = torch.nn.parallel.DistributedDataParallel(
+                model,
+                device_ids=[model.device] if model.device.type == "cuda" else None,
+                # the transformer of a linear probe gets no gradients
+                find_unused_parameters=linear_probe,
+            )
+            minibatch_size = min(
+                minibatch_size_per_replica, batch_size // get_world_size()
+            )
+            print(
+                f"Using DDP across {get_world_size()} processes, with a minibatch "
+                f"size of {minibatch_size} per process"
+            )
         # data parallel:  currently not supported with model parallel
-        if torch.cuda.device_count() > 1:
+        elif torch.cuda.device_count() > 1:
             model = torch.nn.DataParallel(model, output_device=0)
             minibatch_size = min(
                 minibatch_size_per_replica * torch.cuda.device_count(), batch_size
             )
-            eval_batch_size = min(torch.cuda.device_count(), eval_batch_size)
+            if eval_max_tokens is not None:
+                # eval batches are split across devices
+                eval_max_tokens *= torch.cuda.device_count()
+            else:
+                eval_batch_size = min(torch.cuda.device_count(), eval_batch_size)
             print(
                 "Using",
                 torch.cuda.device_count(),
@@ -432,11 +801,18 @@ def train_and_save_model(
     if already_trained:
         print("Model already trained, skipping training")
         test_results, test_metrics = eval_loop(
-            model,
+            CompiledModel(model) if compile_model else model,
             test_ds,
             eval_batch_size,
             metric_prefix="eval",
             remove_large_columns=False,
+            bucket_by_length=bucket_by_length,
+            max_tokens=eval_max_tokens,
+            arrays=feature_arrays(test_ds),
+            pack_length=pack_length,
+            cache_prefix=cache_prefix,
+            head_names=head_names,
+            pad_to_bucket=compile_model,
         )
     else:
         start = time.time()
@@ -461,35 +837,76 @@ def train_and_save_model(
             metric_for_best_model=metric_for_best_model,
             greater_is_better=greater_is_better,
             save_total_limit=save_total_limit,
+            bucket_by_length=bucket_by_length,
+            seed=seed,
+            eval_max_tokens=eval_max_tokens,
+            prefetch_depth=prefetch_depth,
+            cache_features=cache_features,
+            feature_cache_dir=feature_cache_dir,
+            feature_dtype=feature_dtype,
+            pack_length=pack_length,
+            cache_prefix=cache_prefix,
+            best_in_memory_max_bytes=best_in_memory_max_bytes,
+            compile_model=compile_model,
+            train_metrics_window=train_metrics_window,
         )
         print("Model training took", time.time() - start, "seconds")
 
     inference_results = None
+    quantized_metrics: dict = {}
+    if inference_ds and quantize_inference:
+        model = quantize_for_inference(model)
+        _, quantized_metrics = eval_loop(
+            model,
+            test_ds,
+            eval_batch_size,
+            metric_prefix="eval_quantized",
+            remove_large_columns=True,
+            bucket_by_length=bucket_by_length,
+            max_tokens=eval_max_tokens,
+            pack_length=pack_length,
+            cache_prefix=cache_prefix,
+            head_names=head_names,
+        )
+        # how much quantization changes test metrics
+        for key, value in list(quantized_metrics.items()):
+            if key.endswith(("/acc", "/auroc")):
+                delta = value - test_metrics[key.replace("eval_quantized", "eval", 1)]
+                quantized_metrics[f"{key}_delta"] = delta
+                print(f"\t{key}_delta: {delta:+.4f}")
+        logger.logkvs(quantized_metrics)
     if inference_ds:
         inference_results, inferenece_metrics = eval_loop(
-            model,
+            # quantized models are run eagerly
+            CompiledModel(model) if compile_model and not quantize_inference else model,
             inference_ds,
             eval_batch_size,
             metric_prefix="inference",
             remove_large_columns=False,
+            bucket_by_length=bucket_by_length,
+            max_tokens=eval_max_tokens,
+            # cached features are those of the unquantized model
+            arrays=None if quantize_inference else feature_arrays(inference_ds),
+            pack_length=pack_length,
+            cache_prefix=cache_prefix,
+            head_names=head_names,
+            pad_to_bucket=compile_model,
         )
         logger.logkvs(inferenece_metrics)
 
-    if save_path:
+    def avg_acc(results):
+        if isinstance(results, dict):  # several heads
+            return {name: avg_acc(r) for name, r in results.items()}
+        return float(np.mean(results["acc"] if results else [np.nan]))
+
+    if save_path and is_main_process():
         with open(os.path.join(save_path, "results.pkl"), "wb") as f:
             pickle.dump(
                 {
-                    "avg_acc_test": float(
-                        np.mean([r["acc"] for r in test_results])  # type: ignore
-                    ),
-                    "avg_acc_inference": float(
-                        np.mean(
-                            [r["acc"] for r in inference_results]  # type: ignore
-                            if inference_results
-                            else [np.nan]
-                        )
-                    ),
+                    "avg_acc_test": avg_acc(test_results),
+                    "avg_acc_inference": avg_acc(inference_results),
                     **test_metrics,
+                    **quantized_metrics,
                 },
                 f,
             )
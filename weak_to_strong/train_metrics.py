@@ -0,0 +1,97 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from weak_to_strong.eval import compute_metrics
+
+
+class WindowedTrainMetrics:
+    """
+    Computes the train metrics of compute_metrics (AUROC, calibration, CDR, etc.)
+    over the examples of windows of `window` consecutive steps, rather than of every
+    step. Windows of several steps are computed in a background thread so that
+    training doesn't wait for them, and windows of one step synchronously.
+
+    The log row of each step is held until the metrics of its window are computed,
+    and these metrics are added to the row of the last step of the window, so that
+    they are logged at the step they cover (see `rows`).
+    """
+
+    def __init__(self, window: int, metric_prefixes: list[str]):
+        assert window > 0, "the metrics window must hold at least one step"
+        self.window = window
+        self.metric_prefixes = metric_prefixes
+        self.executor = ThreadPoolExecutor(max_workers=1) if window > 1 else None
+        # (log rows, metrics) of the windows submitted, in order
+        self.pending: list[tuple[list[dict], Future]] = []
+        self.steps: list[tuple] = []
+
+    def add(
+        self,
+        step: int,
+        row: dict,
+        pred_probs: np.ndarray,
+        gt_soft_labels: np.ndarray,
+        weak_soft_labels: Optional[np.ndarray] = None,
+    ):
+        """
+        Adds a step, with its log row and its predictions as [batch_size] or
+        [batch_size, num_heads] probabilities of the positive class.
+        """
+        self.steps.append((step, row, pred_probs, gt_soft_labels, weak_soft_labels))
+        if len(self.steps) == self.window:
+            self._submit()
+
+    def _submit(self):
+        steps, self.steps = self.steps, []
+        rows = [s[1] for s in steps]
+        if self.executor is None:
+            future: Future = Future()
+            future.set_result(self._compute(steps))
+        else:
+            future = self.executor.submit(self._compute, steps)
+        self.pending.append((rows, future))
+
+    def _compute(self, steps: list[tuple]) -> dict[str, float]:
+        pred_probs, gt_soft_labels, weak_soft_labels = [
+            np.concatenate([s[i] for s in steps]) if steps[0][i] is not None else None
+            for i in range(2, 5)
+        ]
+        metrics = {}
+        for k, prefix in enumerate(self.metric_prefixes):
+            metrics.update(
+                compute_metrics(
+                    gt_soft_labels=gt_soft_labels,
+                    pred_probs=pred_probs if pred_probs.ndim == 1 else pred_probs[:, k],
+                    weak_soft_labels=weak_soft_labels,
+                    metric_prefix=prefix,
+                )
+            )
+        if self.window > 1:
+            metrics["train/window_first_step"] = steps[0][0]
+        return metrics
+
+    def rows(self, wait: bool = False) -> list[dict]:
+        """
+        Returns the log rows of the steps whose window has been computed since the
+        last call, in order. The metrics of a window are added to the row of its last
+        step, without replacing the values of the row (e.g. the accuracy of the
+        step). If wait is True, the remaining steps form a last (possibly shorter)
+        window, and all windows are waited for.
+        """
+        if wait and self.steps:
+            self._submit()
+        rows = []
+        while self.pending and (wait or self.pending[0][1].done()):
+            window_rows, future = self.pending.pop(0)
+            metrics = future.result()
+            window_rows[-1].update(
+                {k: v for k, v in metrics.items() if k not in window_rows[-1]}
+            )
+            rows.extend(window_rows)
+        return rows
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,108 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import datasets
+import numpy as np
+
+WEAK_LABELS_FORMAT = "weak_labels_npy_v1"
+META_FILE = "weak_labels.json"
+
+
+@dataclass
+class WeakLabels:
+    """
+    Weak supervisor predictions, keyed by example id. Arrays are memory-mapped
+    when loaded from disk.
+    """
+
+    # [n] byte strings
+    ids: np.ndarray
+    # [n, 2] float32 soft predictions
+    soft_preds: np.ndarray
+    # [n, 2] float32 logits, if saved
+    logits: Optional[np.ndarray] = None
+
+
+def save_weak_labels(
+    results: datasets.Dataset, path: str, save_logits: bool = False
+) -> None:
+    """
+    Saves the ids and soft predictions (and optionally logits) of the weak model's
+    inference results as .npy files, which are much smaller than the full results.
+    The metadata file is written last, so that partially written stores are never
+    picked up by `is_weak_label_store`.
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        "id": np.array(results["id"], dtype=np.bytes_),
+        "soft_pred": np.asarray(results["soft_pred"], dtype=np.float32),
+    }
+    if save_logits:
+        arrays["logit"] = np.asarray(results["logit"], dtype=np.float32)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump(
+            {"format": WEAK_LABELS_FORMAT, "n": len(results), "arrays": list(arrays)},
+            f,
+        )
+
+
+def is_weak_label_store(path: str) -> bool:
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+def load_weak_labels(path: str) -> WeakLabels:
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    assert (
+        meta["format"] == WEAK_LABELS_FORMAT
+    ), f"Unknown weak labels format {meta['format']}"
+
+    def load(name):
+        return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+    return WeakLabels(
+        ids=load("id"),
+        soft_preds=load("soft_pred"),
+        logits=load("logit") if "logit" in meta["arrays"] else None,
+    )
+
+
+def join_weak_labels(
+    ds: datasets.Dataset, weak_labels: WeakLabels, min_match_rate: float = 0.9
+) -> datasets.Dataset:
+    """
+    Returns the examples of ds that have a weak prediction, with the weak soft
+    predictions as soft_label and hard_label. The ground truth labels are kept as
+    gt_soft_label and gt_hard_label.
+
+    A few examples may lack a weak prediction or be missing from ds (e.g. the weak
+    model's last partial eval batch, or examples only one tokenizer filtered as too
+    long). If fewer than min_match_rate of the examples of the smaller side match,
+    the weak labels were most likely made on another split (e.g. with another seed
+    or n_train2_docs), and a ValueError is raised.
+    """
+    ds_ids = np.array(ds["id"], dtype=np.bytes_)
+    sorter = np.argsort(weak_labels.ids)
+    pos = np.searchsorted(weak_labels.ids, ds_ids, sorter=sorter)
+    pos = sorter[np.minimum(pos, len(sorter) - 1)]
+    keep = np.flatnonzero(weak_labels.ids[pos] == ds_ids)
+    match_rate = len(keep) / max(min(len(ds), len(weak_labels.ids)), 1)
+    if match_rate < min_match_rate:
+        raise ValueError(
+            f"Only {len(keep)} of {len(ds)} examples match the {len(weak_labels.ids)} "
+            "weak labels: were they made with another seed or split sizes?"
+        )
+    if len(keep) < len(ds):
+        print(f"No weak labels for {len(ds) - len(keep)} of {len(ds)} examples")
+
+    soft_preds = np.asarray(weak_labels.soft_preds[pos[keep]])
+    ds = ds.select(keep).rename_columns(
+        {"hard_label": "gt_hard_label", "soft_label": "gt_soft_label"}
+    )
+    ds = ds.add_column("soft_label", soft_preds.tolist())
+    ds = ds.add_column("hard_label", soft_preds.argmax(axis=-1).tolist())
+    return ds